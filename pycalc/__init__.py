@@ -2,8 +2,53 @@
 Package for calculating mathematical expressions.
 
 This package provide calc() function for evaluation mathematical expression
-using customized shunting-yard and reverse polish notation algorithms.
+using customized shunting-yard and reverse polish notation algorithms,
+and compile() function for parsing expression once and evaluating it
+many times with different values of variables.
+calc_stream() evaluates huge expression read by chunks in bounded memory.
+calc_many() evaluates many expressions in parallel worker processes,
+estimate_cost() predicts cost of expression for their scheduling.
+Calculator objects own their modules and caches and can be used
+from many threads. Budget limits resources of their evaluation.
+Workbook keeps named formulas and recalculates only formulas that
+depend on changed cells.
 """
 
 
-from pycalc.rpn_calc import calc  # noqa
+__version__ = '0.0.3'
+
+import sys
+
+from pycalc.rpn_calc import (calc, calc_stream, compile,  # noqa
+                             Calculator, CompiledExpression)
+from pycalc.budget import Budget, BudgetExceeded  # noqa
+
+# Names of modules, that are imported on first use of their names,
+# so $pycalc EXPRESSION doesn't pay for them
+_LAZY = {'calc_many': 'pycalc.batch', 'estimate_cost': 'pycalc.cost',
+         'Workbook': 'pycalc.workbook'}
+
+if sys.version_info < (3, 7):
+    # module __getattr__ is python 3.7+
+    from pycalc.batch import calc_many  # noqa
+    from pycalc.cost import estimate_cost  # noqa
+    from pycalc.workbook import Workbook  # noqa
+
+
+def __getattr__(name):
+    """
+    Import module of lazy name on its first use.
+    """
+    if name not in _LAZY:
+        raise AttributeError("module 'pycalc' has no attribute " + name)
+    import importlib
+    value = getattr(importlib.import_module(_LAZY[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """
+    Names of package with lazy names, that are not imported yet.
+    """
+    return sorted(set(globals()) | set(_LAZY))
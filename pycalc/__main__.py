@@ -2,7 +2,6 @@
 """
 Main module for handling execution of module like $python3 -m pycalc "1+1"
 """
-import argparse
 import sys
 
 from pycalc import calc
@@ -11,31 +10,117 @@ from pycalc import calc
 def _parse_args():
     """
     Function that parse arguments using argparse package.
-    :return: tuple(EXPRESSION,MODULE*,verbose)
+    :return: tuple(EXPRESSION,MODULE*,verbose,batch,jobs,schedule)
     """
+    import argparse
     parser = argparse.ArgumentParser(
         'pycalc',
         description='Pure-python command-line calculator',
-        usage='%(prog)s EXPRESSION [-h] [-v] [-m [MODULE [MODULE ...]]]')
+        usage='%(prog)s EXPRESSION [-h] [-v] [-m [MODULE [MODULE ...]]]\n'
+              '       %(prog)s --batch FILE [-j N] [--schedule] '
+              '[-m [MODULE [MODULE ...]]]')
     parser.add_argument(
         '-m', '--use-modules', default='',
         help='additional modules to use', nargs='*',
         metavar='MODULE')
-    parser.add_argument('EXPRESSION', help='expression string to evaluate')
+    parser.add_argument('EXPRESSION', help='expression string to evaluate',
+                        nargs='?')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='print verbose information')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='evaluate newline-separated expressions '
+                             'from FILE, "-" for stdin')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='number of worker processes for --batch')
+    parser.add_argument('--schedule', action='store_true',
+                        help='balance --batch workers by estimated cost '
+                             'of expressions')
     args = parser.parse_args()
-    return str(args.EXPRESSION), args.use_modules, args.verbose
+    if (args.EXPRESSION is None) == (args.batch is None):
+        parser.error('one of EXPRESSION or --batch FILE is required')
+    return (str(args.EXPRESSION), args.use_modules, args.verbose,
+            args.batch, args.jobs, args.schedule)
+
+
+def _serve(args):
+    """
+    Parse arguments of serve command and run server.
+    """
+    import argparse
+    from pycalc.budget import Budget
+    from pycalc.server import serve
+    parser = argparse.ArgumentParser(
+        'pycalc serve',
+        description='Serve JSON-lines expression evaluation requests '
+                    'on local socket')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='loopback address to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='TCP port to listen on')
+    parser.add_argument('--unix', metavar='PATH',
+                        help='listen on Unix socket instead of TCP port')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='number of worker processes')
+    parser.add_argument('--max-pending', type=int, default=64, metavar='N',
+                        help='max requests in flight per connection')
+    parser.add_argument('--max-inflight', type=int, default=1024,
+                        metavar='N',
+                        help='max requests in flight for whole server')
+    parser.add_argument('--max-bits', type=int, default=100000,
+                        metavar='N',
+                        help='max bit length of integer results')
+    parser.add_argument('--max-operations', type=int, default=100000,
+                        metavar='N',
+                        help='max number of operations of expression')
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        metavar='SECONDS',
+                        help='max time of evaluation of expression')
+    parser.add_argument('--max-tokens', type=int, default=10000,
+                        metavar='N',
+                        help='max number of tokens of expression')
+    args = parser.parse_args(args)
+    budget = Budget(args.max_bits, args.max_operations, args.timeout,
+                    args.max_tokens)
+    try:
+        serve(args.host, args.port, args.unix, args.jobs,
+              max_pending=args.max_pending, max_inflight=args.max_inflight,
+              budget=budget)
+    except ValueError as error:
+        parser.error(str(error))
+
+
+def _simple_expr(args):
+    """
+    Recognize the simplest call $pycalc EXPRESSION, that is calculated
+    without loading argparse.
+    :return: EXPRESSION or None for other calls
+    """
+    if len(args) == 1 and args[0] != 'serve' and not args[0].startswith('-'):
+        return args[0]
+    return None
 
 
 def _main():
     try:
+        expr = _simple_expr(sys.argv[1:])
+        if expr is not None:
+            print(calc(expr))
+            return
+        if sys.argv[1:2] == ['serve']:
+            _serve(sys.argv[2:])
+            return
         if len(sys.argv) == 1:
             while True:
                 expr = input(">>")
                 print(calc(expr))
-        print(calc(*_parse_args()))
-    except (ArithmeticError, ImportError) as error:
+        expr, modules, verbose, batch, jobs, schedule = _parse_args()
+        if batch is not None:
+            from pycalc.batch import iter_lines, run_batch
+            errors = run_batch(iter_lines(batch), modules, jobs=jobs,
+                               schedule=schedule)
+            raise SystemExit(1 if errors else 0)
+        print(calc(expr, modules, verbose))
+    except (ArithmeticError, ImportError, OSError) as error:
         print("ERROR:", error, file=sys.stderr)
         raise SystemExit
     except (EOFError, KeyboardInterrupt):
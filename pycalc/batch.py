@@ -0,0 +1,272 @@
+"""
+This module provide batch evaluation of newline-separated expressions
+read as a stream from file or stdin, and calc_many() function for
+evaluation of many expressions in parallel worker processes.
+Scheduled evaluation packs expressions to workers by estimate_cost()
+and sends outliers to dedicated worker.
+"""
+import heapq
+import itertools
+import mmap
+import os
+import sys
+
+from collections import deque
+
+from pycalc.cost import estimate_cost
+from pycalc.rpn_calc import Calculator
+
+
+def _decode(line):
+    """
+    Decode UTF-8 line, line that can't be decoded is returned as
+    UnicodeDecodeError, so it is reported as error of its line.
+    """
+    try:
+        return str(line, 'utf-8').rstrip('\r')
+    except UnicodeDecodeError as error:
+        # copy of line, error must not keep view of closed mmap
+        return UnicodeDecodeError(error.encoding, bytes(line), error.start,
+                                  error.end, error.reason)
+
+
+def _iter_mmap_lines(path):
+    """
+    Split memory-mapped file in lines and decode every line directly
+    from mapped memory, so file is never loaded whole.
+    """
+    with open(path, 'rb') as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can't be mapped
+            return
+    with mapped, memoryview(mapped) as view:
+        pos, end = 0, len(mapped)
+        while pos < end:
+            eol = mapped.find(b'\n', pos)
+            if eol == -1:
+                eol = end
+            yield _decode(view[pos:eol])
+            pos = eol + 1
+
+
+def iter_lines(source):
+    """
+    Iterate over lines of file without line endings.
+    :param source: path of file or '-' for stdin
+    :return: generator of lines, UnicodeDecodeError for line,
+             that is not valid UTF-8
+    """
+    if source == '-':
+        return (_decode(line.rstrip(b'\n')) for line in sys.stdin.buffer)
+    return _iter_mmap_lines(source)
+
+
+def _calc_chunk(chunk, calculator):
+    """
+    Calculate list of expressions. Equivalent expressions share
+    compiled expression, see Calculator.compile(), so pure expression
+    is calculated once and its result is used for all its lines.
+    :return: list of results, exception object for failed expression
+    """
+    results = []
+    # compiled expression -> result
+    calculated = {}
+    for expr in chunk:
+        try:
+            compiled = calculator.compile(expr)
+            if compiled in calculated:
+                result = calculated[compiled]
+            else:
+                result = calculator.calc(expr)
+                if compiled.pure:
+                    calculated[compiled] = result
+        except ImportError:
+            raise
+        except Exception as error:
+            result = error
+        results.append(result)
+    return results
+
+
+def _init_worker(modules):
+    """
+    Create calculator and import its modules once at start
+    of worker process.
+    """
+    global _worker_calculator
+    _worker_calculator = Calculator(modules)
+
+
+def _worker_calc_chunk(chunk):
+    """
+    Calculate chunk in worker process with calculator of the pool.
+    """
+    return _calc_chunk(chunk, _worker_calculator)
+
+
+def _estimate(expr):
+    """
+    Total cost of expression, expression with error is cheap: error is
+    reported by its calculation, so scheduling never changes results.
+    """
+    try:
+        return estimate_cost(expr).total
+    except Exception:
+        return 1
+
+
+def _schedule(costs, workers):
+    """
+    Split window of expressions between worker processes. Expression,
+    that costs more than fair share of one worker, is outlier: it can't
+    be balanced and goes to dedicated lane, there are less outliers than
+    workers. The rest are packed in bins of about equal cost: the most
+    expensive expression goes to the cheapest bin first.
+    :param costs: costs of expressions of window
+    :param workers: number of worker processes
+    :return: tuple(indexes of outliers, list of lists of indexes of bins)
+    """
+    fair = sum(costs) / workers
+    outliers = [index for index, cost in enumerate(costs) if cost > fair]
+    # heap of bins: tuple(total cost, number of bin, indexes)
+    bins = [(0, number, []) for number in range(workers)]
+    for index in sorted(set(range(len(costs))).difference(outliers),
+                        key=costs.__getitem__, reverse=True):
+        total, number, indexes = heapq.heappop(bins)
+        indexes.append(index)
+        heapq.heappush(bins, (total + costs[index], number, indexes))
+    return outliers, [sorted(indexes) for _, _, indexes in bins if indexes]
+
+
+def _collect(size, tasks):
+    """
+    Results of tasks of window in order of expressions.
+    :param size: number of expressions in window
+    :param tasks: list of tuples(indexes of expressions, AsyncResult)
+    """
+    results = [None] * size
+    for indexes, task in tasks:
+        for index, result in zip(indexes, task.get()):
+            results[index] = result
+    return results
+
+
+def _calc_scheduled(exprs, modules, workers, chunksize):
+    """
+    Calculate windows of workers * chunksize expressions in pool of
+    worker processes and one process of outliers, see _schedule().
+    Next window is sent before results of current one are collected.
+    """
+    import multiprocessing
+    windows = iter(lambda: list(itertools.islice(exprs, workers * chunksize)),
+                   [])
+    with multiprocessing.Pool(workers, _init_worker, (modules,)) as pool, \
+            multiprocessing.Pool(1, _init_worker, (modules,)) as lane:
+        pending = deque()
+        for window in windows:
+            outliers, bins = _schedule([_estimate(expr) for expr in window],
+                                       workers)
+            tasks = [(indexes, pool.apply_async(
+                _worker_calc_chunk, ([window[i] for i in indexes],)))
+                for indexes in bins]
+            if outliers:
+                tasks.append((outliers, lane.apply_async(
+                    _worker_calc_chunk, ([window[i] for i in outliers],))))
+            pending.append((len(window), tasks))
+            if len(pending) >= 2:
+                yield from _collect(*pending.popleft())
+        while pending:
+            yield from _collect(*pending.popleft())
+
+
+def calc_many(exprs, modules=(), workers=None, chunksize=1024,
+              schedule=False):
+    """
+    Calculate many expressions in pool of worker processes.
+
+    Expressions are sent to workers in chunks, number of chunks in flight
+    is bounded, so exprs can be a long generator. Equivalent pure
+    expressions of one chunk are calculated once.
+    Scheduled calculation splits windows of workers * chunksize
+    expressions in chunks of equal estimated cost, expressions that cost
+    more than fair share of one worker are calculated by extra process,
+    so few huge expressions don't delay the rest.
+    Failure of one expression does not stop calculation of the rest,
+    exception object is yielded instead of its result.
+
+    :param exprs: iterable of expressions
+    :param modules: Additional modules
+    :param workers: number of worker processes, os.cpu_count() if None,
+                    expressions are calculated in current process if 1
+    :param chunksize: number of expressions in one chunk
+    :param schedule: pack chunks by estimate_cost() of expressions
+    :return: generator of results in order of exprs
+    """
+    modules = tuple(modules)
+    # raise ImportError here instead of in every worker
+    calculator = Calculator(modules)
+    workers = os.cpu_count() if workers is None else workers
+    exprs = iter(exprs)
+    chunks = iter(lambda: list(itertools.islice(exprs, chunksize)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _calc_chunk(chunk, calculator)
+        return
+    if schedule:
+        yield from _calc_scheduled(exprs, modules, workers, chunksize)
+        return
+    # imported here, it is slow to import for command line calculator
+    import multiprocessing
+    with multiprocessing.Pool(workers, _init_worker, (modules,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_worker_calc_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+def run_batch(lines, modules=(), out=None, err=None, jobs=1,
+              schedule=False):
+    """
+    Calculate every non-empty line and write results in order of lines.
+
+    Error in expression is written to err with line number and
+    does not stop calculation of next lines.
+    :param lines: iterable of expressions, exception object for line,
+                  that can't be read, see iter_lines()
+    :param modules: Additional modules
+    :param out: file for results, sys.stdout by default
+    :param err: file for errors, sys.stderr by default
+    :param jobs: number of worker processes
+    :param schedule: pack chunks of workers by estimated cost
+    :return: number of lines with errors
+    """
+    out = sys.stdout if out is None else out
+    err = sys.stderr if err is None else err
+    numbers = deque()
+
+    def exprs():
+        for number, expr in enumerate(lines, 1):
+            if isinstance(expr, Exception):
+                # empty expression keeps place of error in results
+                numbers.append((number, expr))
+                yield ''
+            elif expr.strip():
+                numbers.append((number, None))
+                yield expr
+
+    errors = 0
+    for result in calc_many(exprs(), modules, jobs, schedule=schedule):
+        number, error = numbers.popleft()
+        if error is not None:
+            result = error
+        if isinstance(result, Exception):
+            errors += 1
+            print("ERROR: line {}: {}".format(number, result), file=err)
+        else:
+            print(result, file=out)
+    return errors
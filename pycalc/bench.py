@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for pycalc package, run as $python3 -m pycalc.bench
+
+Default run measures every stage of calc() on the test suite corpus and
+on synthetic workloads, start of command line calculator in new
+interpreter, prints JSON results and compares them with saved baseline:
+    $python3 -m pycalc.bench --output baseline.json
+    $python3 -m pycalc.bench --baseline baseline.json --threshold 0.2
+"""
+import argparse
+import functools
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+import pycalc
+from pycalc.closures import build
+from pycalc.cost import estimate_cost
+from pycalc.ext_modules import get_namespace
+from pycalc.program import run
+from pycalc.rpn_calc import (calc, calc_stream, compile, cache_clear,
+                             cache_configure, cache_info, _modify_expr,
+                             _postfix_queue, _rpn_calc, _scan,
+                             _tokenize_expr, _unary_replace)
+
+# Expressions of test_pycalc.py test suite
+TEST_EXPRESSIONS = (
+    '2+2 *2',
+    '(2(2))',
+    '1+2*3**4',
+    '-13',
+    '-2**2',
+    '(2+3)*4',
+    '-(1)',
+    '-5**-1',
+    '-5**-(1)-1',
+    'pi*(-1)',
+    '-pi',
+    '1*4+3.3/(3 + .3)*3(sqrt(4))/(sin(0) + 1)',
+    '2^(2^2)',
+    'sin(1,)',
+    '--1',
+    '3--+---++1',
+    'min(range(10))',
+    '10 == 10.0',
+    '10 != 10.0',
+    'False + 1',
+    'len(list(range(10))*2)',
+    '4**2**3',
+    '-5**-1-1',
+    '10**-2',
+    'log10(100)',
+    '-13',
+    '6-(-13)',
+    '1---1',
+    '-+---+-1',
+    '1+2*2',
+    '1+(2+3*2)*3',
+    '10*(2+1)',
+    '10**(2+1)',
+    '100/3**2',
+    '100/3%2**2',
+    'pi+e',
+    'log(e)',
+    'sin(pi/2)',
+    'log10(100)',
+    'sin(pi/2)*111*6',
+    '2*sin(pi/2)',
+    '102%12%7',
+    '100/4/3',
+    '2**3**4',
+    '1+2*3==1+2*3',
+    'e**5>=e**5+1',
+    '1+2*4/3+1!=1+2*4/3+2',
+    '(100)',
+    '666',
+    '10(2+1)',
+    '-.1',
+    '1/3',
+    '1.0/3.0',
+    '.1 * 2.0**56.0',
+    'e**34',
+    '(2.0**(pi/pi+e/e+2.0**0.0))',
+    '(2.0**(pi/pi+e/e+2.0**0.0))**(1.0/3.0)',
+    'sin(pi/2**1) + log(1*4+2**2+1, 3**2)',
+    '10*e**0*log10(.4* -5/ -0.1-10) - -abs(-53/10) + -5',
+    'sin(-cos(-sin(3.0)-cos(-sin(-3.0*5.0)'
+    '-sin(cos(log10(43.0))))+cos(sin(sin(34.0-2.0**2.0))))-'
+    '-cos(1.0)--cos(0.0)**3.0)',
+    '2.0**(2.0**2.0*2.0**2.0)',
+    'sin(e**log(e**e**sin(23.0),45.0) + cos(3.0+log10(e**-e)))',
+)
+
+# Piece of expression with every kind of token
+_CHUNK = 'sin(1.5)*2.5+3**-2//(4-1)%10>=.5+2!=abs(-7) - '
+
+
+def synthetic_expr(size):
+    """
+    Generate valid expression of about given length from repeated _CHUNK.
+    :param size: length of expression in characters
+    :return: expression string
+    """
+    return _CHUNK * max(1, size // len(_CHUNK)) + '1'
+
+
+def tokenize_scaling(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6), repeat=3):
+    """
+    Measure _tokenize_expr time on expressions of growing length.
+    With linear tokenizer time per character stays the same.
+    :param sizes: lengths of expressions
+    :param repeat: number of measures, the best one is used
+    :return: list of tuples(size, seconds, nanoseconds per character)
+    """
+    results = []
+    for size in sizes:
+        expr = _modify_expr(synthetic_expr(size))
+        best = min(timeit.repeat(lambda: _tokenize_expr(expr),
+                                 number=1, repeat=repeat))
+        results.append((len(expr), best, best * 1e9 / len(expr)))
+    return results
+
+
+def stream_memory(sizes=(10 ** 4, 10 ** 5, 10 ** 6), chunk=4096):
+    """
+    Compare peak memory of calc() without cache and of calc_stream()
+    on expressions of growing length read by chunks.
+    :param sizes: lengths of expressions
+    :param chunk: length of chunks of calc_stream()
+    :return: list of tuples(size, bytes of calc(), bytes of calc_stream())
+    """
+    results = []
+    info = cache_info()
+    cache_configure(maxsize=0)
+    try:
+        for size in sizes:
+            expr = synthetic_expr(size)
+            peaks = []
+            for function in (lambda: calc(expr), lambda: calc_stream(
+                    expr[i:i + chunk] for i in range(0, len(expr), chunk))):
+                tracemalloc.start()
+                try:
+                    function()
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+            results.append((len(expr), *peaks))
+    finally:
+        cache_configure(info.maxsize, info.ttl)
+    return results
+
+
+# Expressions with heavy calls and big integers for cost_accuracy()
+HEAVY_EXPRESSIONS = (
+    'factorial(500)', 'factorial(5000)', 'factorial(20000)', '3**10000',
+    '3**200000', '7**5000 * 11**5000', '12345**20000 * 54321**20000',
+    '2**100000 // 3**30000', 'comb(5000, 2500)', 'comb(20000, 10000)',
+    'hypot(3, 4) + gamma(5.5)',
+)
+
+
+def _ranks(values):
+    """
+    Ranks of values, 0 for the smallest one.
+    """
+    order = sorted(range(len(values)), key=values.__getitem__)
+    ranks = [0] * len(values)
+    for rank, index in enumerate(order):
+        ranks[index] = rank
+    return ranks
+
+
+def cost_accuracy(exprs=None, scale=1, target=0.01, repeat=3):
+    """
+    Compare cost predicted by estimate_cost() with measured time of calc()
+    without cache on test suite, synthetic and heavy expressions.
+    :param exprs: expressions, default corpus if None
+    :param scale: multiplier of synthetic expression sizes
+    :param target: approximate seconds of one measure
+    :param repeat: number of measures, the best one is used
+    :return: tuple(rank correlation of predicted and measured costs,
+             microseconds per unit of cost, list of tuples(expr,
+             predicted cost, measured seconds))
+    """
+    if exprs is None:
+        exprs = (TEST_EXPRESSIONS + HEAVY_EXPRESSIONS + tuple(
+            synthetic_expr(size * scale) for size in (100, 1000, 10000)))
+    info = cache_info()
+    cache_configure(maxsize=0)
+    results = []
+    try:
+        for expr in exprs:
+            results.append((expr, estimate_cost(expr).total,
+                            _measure(lambda: calc(expr), target, repeat)))
+    finally:
+        cache_configure(info.maxsize, info.ttl)
+    predicted = _ranks([cost for _, cost, _ in results])
+    measured = _ranks([seconds for _, _, seconds in results])
+    count = len(results)
+    # Spearman correlation of ranks without ties
+    correlation = 1 - 6 * sum((p - m) ** 2 for p, m in zip(
+        predicted, measured)) / (count * (count ** 2 - 1))
+    per_unit = (sum(seconds for _, _, seconds in results) /
+                sum(cost for _, cost, _ in results) * 1e6)
+    return correlation, per_unit, results
+
+
+def evaluation_speedup(exprs=TEST_EXPRESSIONS, number=1000, repeat=3):
+    """
+    Compare evaluation of postfix queue by _rpn_calc() with
+    evaluation of compiled Program.
+    :param exprs: expressions for benchmark
+    :param number: number of evaluations of every expression in one measure
+    :param repeat: number of measures, the best one is used
+    :return: tuple(seconds of _rpn_calc, seconds of Program, speedup)
+    """
+    namespace = get_namespace(['math', 'builtins'])
+    queue_time = program_time = 0
+    for expr in exprs:
+        queue = _scan(expr)
+        program = compile(expr).program
+        queue_time += min(timeit.repeat(
+            lambda: _rpn_calc(queue, namespace=namespace),
+            number=number, repeat=repeat))
+        program_time += min(timeit.repeat(
+            lambda: run(program, None), number=number, repeat=repeat))
+    return queue_time, program_time, queue_time / program_time
+
+
+def backend_speedup(exprs=TEST_EXPRESSIONS, number=1000, repeat=3):
+    """
+    Compare evaluation of compiled Program by stack interpreter with
+    evaluation of its closure tree.
+    :param exprs: expressions for benchmark
+    :param number: number of evaluations of every expression in one measure
+    :param repeat: number of measures, the best one is used
+    :return: tuple(seconds of stack, seconds of closures, speedup)
+    """
+    stack_time = closure_time = 0
+    for expr in exprs:
+        program = compile(expr).program
+        closure = build(program) or functools.partial(run, program)
+        stack_time += min(timeit.repeat(
+            lambda: run(program, None), number=number, repeat=repeat))
+        closure_time += min(timeit.repeat(
+            lambda: closure(None), number=number, repeat=repeat))
+    return stack_time, closure_time, stack_time / closure_time
+
+
+def workloads(scale=1):
+    """
+    Corpus of benchmark: test suite expressions and synthetic workloads
+    growing in length, nesting depth and number of function arguments,
+    and branches of if(), 'and', 'or' that are never taken.
+    :param scale: multiplier of synthetic workload sizes
+    :return: dict workload name -> tuple of expressions
+    """
+    corpus = {'test_suite': TEST_EXPRESSIONS}
+    for size in (100 * scale, 1000 * scale, 10000 * scale):
+        corpus['length_{}'.format(size)] = (synthetic_expr(size),)
+    for depth in (10 * scale, 50 * scale, 200 * scale):
+        corpus['depth_{}'.format(depth)] = (
+            '1+(' * depth + '1' + ')' * depth,
+            'abs(' * depth + '-1' + ')' * depth)
+    for count in (2 * scale, 16 * scale, 128 * scale):
+        args = ', '.join(str(i) for i in range(count))
+        corpus['args_{}'.format(count)] = ('max(' + args + ')',
+                                           'min(' + args + ')')
+    # compiled programs jump over untaken branch, _rpn_calc calculates it
+    for size in (100 * scale, 1000 * scale):
+        skipped = synthetic_expr(size)
+        corpus['branches_{}'.format(size)] = (
+            'if(1 < 2, 1, ' + skipped + ')', '0 and ' + skipped,
+            '1 or ' + skipped)
+    return corpus
+
+
+def _measure(function, target, repeat):
+    """
+    Measure time of one call of function, number of calls in
+    one measure is chosen to take about target seconds.
+    :return: best time of one call in seconds
+    """
+    single = timeit.timeit(function, number=1)
+    number = max(1, int(target / max(single, 1e-7)))
+    return min(timeit.repeat(function, number=number,
+                             repeat=repeat)) / number
+
+
+def measure_stages(exprs, target=0.01, repeat=3):
+    """
+    Measure every stage of calculation on expressions.
+
+    Stages are one-pass parsing of calc(), stages of verbose parsing,
+    evaluation of postfix queue by _rpn_calc(), evaluation of compiled
+    Program by stack interpreter and by closure tree, calc() with cache
+    hit and calc() without cache.
+    :param exprs: expressions of workload
+    :param target: approximate seconds of one measure
+    :param repeat: number of measures, the best one is used
+    :return: dict stage -> total seconds for all expressions
+    """
+    namespace = get_namespace(['math', 'builtins'])
+    stages = dict.fromkeys(('scan', 'modify', 'tokenize', 'unary',
+                            'postfix', 'rpn_calc', 'program', 'closure',
+                            'calc', 'calc_cold'), 0)
+    info = cache_info()
+    for expr in exprs:
+        modified = _modify_expr(expr)
+        tokens = _tokenize_expr(modified)
+        unary_tokens = list(tokens)
+        _unary_replace(unary_tokens)
+        queue = _postfix_queue(unary_tokens)
+        program = compile(expr).program
+        # program deeper than closures.MAX_DEPTH is run by interpreter
+        closure = build(program) or functools.partial(run, program)
+        measures = (
+            ('scan', lambda: _scan(expr)),
+            ('modify', lambda: _modify_expr(expr)),
+            ('tokenize', lambda: _tokenize_expr(modified)),
+            # _unary_replace changes list in place, so it gets new copy
+            ('unary', lambda: _unary_replace(list(tokens))),
+            ('postfix', lambda: _postfix_queue(unary_tokens)),
+            ('rpn_calc', lambda: _rpn_calc(queue, namespace=namespace)),
+            ('program', lambda: run(program, None)),
+            ('closure', lambda: closure(None)),
+            ('calc', lambda: calc(expr)),
+        )
+        for stage, function in measures:
+            stages[stage] += _measure(function, target, repeat)
+        cache_configure(maxsize=0)
+        try:
+            stages['calc_cold'] += _measure(lambda: calc(expr), target,
+                                            repeat)
+        finally:
+            cache_configure(info.maxsize, info.ttl)
+    cache_clear()
+    return stages
+
+
+def import_times(module='pycalc.__main__'):
+    """
+    Import module in new interpreter with $python3 -X importtime.
+    :return: dict imported module -> cumulative seconds of its import
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 10 ** 6
+    return times
+
+
+def measure_startup(repeat=5):
+    """
+    Measure start of command line calculator in new interpreters.
+
+    Stages are start of bare interpreter, import of pycalc modules
+    by $python3 -X importtime and whole $python3 -m pycalc "1+1".
+    :param repeat: number of measures, the best one is used
+    :return: dict stage -> seconds
+    """
+    def best(command):
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+
+    return {
+        'interpreter': best([sys.executable, '-c', 'pass']),
+        'import': min(import_times()['pycalc.__main__']
+                      for _ in range(repeat)),
+        'cli': best([sys.executable, '-m', 'pycalc', '1+1']),
+    }
+
+
+def run_suite(corpus=None, target=0.01, repeat=3, startup=False):
+    """
+    Measure all stages on all workloads.
+    :param corpus: dict workload -> expressions, workloads() by default
+    :param startup: measure start of command line calculator
+                    as 'startup' workload too
+    :return: JSON-serializable dict with meta information and results
+    """
+    corpus = workloads() if corpus is None else corpus
+    results = {name: measure_stages(exprs, target, repeat)
+               for name, exprs in corpus.items()}
+    if startup:
+        results['startup'] = measure_startup(repeat)
+    return {
+        'meta': {
+            'pycalc': pycalc.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold=0.1, thresholds=None):
+    """
+    Find regressions of current results against baseline.
+
+    Stage of workload regressed if it became slower than baseline
+    by more than threshold (0.1 is 10%).
+    :param current: results of run_suite()
+    :param baseline: saved results of run_suite()
+    :param threshold: default allowed slowdown
+    :param thresholds: dict stage -> allowed slowdown for that stage
+    :return: list of dicts with workload, stage, baseline, current, ratio
+    """
+    thresholds = thresholds or {}
+    regressions = []
+    for name, stages in current['results'].items():
+        base_stages = baseline['results'].get(name, {})
+        for stage, seconds in stages.items():
+            base = base_stages.get(stage)
+            if not base:
+                continue
+            ratio = seconds / base
+            if ratio > 1 + thresholds.get(stage, threshold):
+                regressions.append({'workload': name, 'stage': stage,
+                                    'baseline': base, 'current': seconds,
+                                    'ratio': ratio})
+    return regressions
+
+
+def _parse_args():
+    """
+    Parse arguments of benchmark.
+    """
+    parser = argparse.ArgumentParser(
+        'python -m pycalc.bench',
+        description='Benchmarks of pycalc stages with regression check')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='save results as JSON to FILE')
+    parser.add_argument('-b', '--baseline', metavar='FILE',
+                        help='compare results with baseline JSON FILE')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='allowed slowdown against baseline, '
+                             'default 0.1 is 10%%')
+    parser.add_argument('--stage-threshold', action='append', default=[],
+                        metavar='STAGE=VALUE',
+                        help='allowed slowdown of one stage')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='multiplier of synthetic workload sizes')
+    parser.add_argument('--target', type=float, default=0.01,
+                        help='approximate seconds of one measure')
+    parser.add_argument('--scaling', action='store_true',
+                        help='run tokenizer scaling, evaluation and '
+                             'backend speedup, streaming memory and '
+                             'cost model benchmarks instead')
+    parser.add_argument('--no-startup', action='store_true',
+                        help='skip measures of command line startup')
+    return parser.parse_args()
+
+
+def _main():
+    args = _parse_args()
+    if args.scaling:
+        print('{:>10} {:>12} {:>10}'.format('chars', 'seconds', 'ns/char'))
+        for size, seconds, per_char in tokenize_scaling():
+            print('{:>10} {:>12.6f} {:>10.1f}'.format(size, seconds,
+                                                      per_char))
+        print('evaluation: queue {:.4f}s, program {:.4f}s, speedup {:.2f}x'
+              .format(*evaluation_speedup()))
+        print('backend: stack {:.4f}s, closure {:.4f}s, speedup {:.2f}x'
+              .format(*backend_speedup()))
+        print('{:>10} {:>14} {:>14}'.format('chars', 'calc bytes',
+                                            'stream bytes'))
+        for size, calc_peak, stream_peak in stream_memory():
+            print('{:>10} {:>14} {:>14}'.format(size, calc_peak,
+                                                stream_peak))
+        print('cost model: rank correlation {:.3f}, {:.2f}us per unit'
+              .format(*cost_accuracy()[:2]))
+        return
+    results = run_suite(workloads(args.scale), args.target,
+                        startup=not args.no_startup)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        thresholds = {stage: float(value) for stage, value in (
+            item.split('=', 1) for item in args.stage_threshold)}
+        results['regressions'] = compare(results, baseline,
+                                         args.threshold, thresholds)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+    if results.get('regressions'):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,193 @@
+"""
+This module provide resource budgets of evaluation: maximum bit length
+of integer results, number of operations, wall-clock time and number
+of tokens of expression.
+
+Budgeted evaluation runs in separate loop, so run() of unlimited
+calculation pays nothing for it. Powers, products and factorials of
+integers, comb() and perm() that would exceed bit length limit are
+rejected by magnitudes of their operands before they are calculated.
+"""
+import builtins
+import math
+import operator
+import time
+
+from collections import namedtuple
+
+from pycalc.program import (PUSH, LOAD, BINARY, STORE, RECALL, JUMP,
+                            _DISPATCH, _jump)
+
+# Limits of evaluation, None means no limit:
+# max_bits - max bit length of integer result of any operation,
+# max_operations - max number of operators and function calls,
+# timeout - max seconds of evaluation,
+# max_tokens - max number of tokens of parsed expression
+Budget = namedtuple('Budget', 'max_bits, max_operations, timeout, max_tokens')
+Budget.__new__.__defaults__ = (None, None, None, None)
+
+
+class BudgetExceeded(ArithmeticError):
+    """
+    Evaluation exceeded limit of its Budget.
+    """
+
+
+def check_tokens(count, budget):
+    """
+    Raise BudgetExceeded if expression has too many tokens.
+    """
+    if budget.max_tokens is not None and count > budget.max_tokens:
+        raise BudgetExceeded("Too many tokens:" + str(count))
+
+
+def _int_bits(value):
+    """
+    Bit length of integer value, None for other types.
+    """
+    if isinstance(value, int):
+        return abs(value).bit_length()
+    return None
+
+
+def _pow_bits(base, exponent):
+    """
+    Lower bound of bit length of base ** exponent for integers.
+    """
+    bits = _int_bits(base)
+    if bits is None or _int_bits(exponent) is None or exponent <= 0:
+        return 0
+    return (bits - 1) * exponent + 1
+
+
+def _mul_bits(operand_1, operand_2):
+    """
+    Lower bound of bit length of product of integers.
+    """
+    bits_1, bits_2 = _int_bits(operand_1), _int_bits(operand_2)
+    if not bits_1 or not bits_2:
+        return 0
+    return bits_1 + bits_2 - 1
+
+
+def _factorial_bits(number):
+    """
+    Lower bound of bit length of factorial of integer: log2(n!) > n*log2(n/e).
+    """
+    if _int_bits(number) is None or number < 3:
+        return 0
+    return int(number * (math.log2(number) - math.log2(math.e)))
+
+
+def _comb_bits(number, chosen):
+    """
+    Lower bound of bit length of comb(n, k) for integers:
+    log2(comb(n, k)) >= k*log2(n/k) for k <= n/2.
+    """
+    if _int_bits(number) is None or _int_bits(chosen) is None:
+        return 0
+    chosen = min(chosen, number - chosen)
+    if chosen < 1:
+        return 0
+    return int(chosen * math.log2(number / chosen))
+
+
+def _perm_bits(number, chosen):
+    """
+    Lower bound of bit length of perm(n, k) for integers: product of
+    k factors, that are at least n-k+1.
+    """
+    if (_int_bits(number) is None or _int_bits(chosen) is None or
+            not 0 < chosen <= number):
+        return 0
+    return int(chosen * math.log2(number - chosen + 1))
+
+
+# Estimators of result bit length by arguments of operators and
+# functions, keys are (function, number of arguments)
+_ESTIMATORS = {
+    (operator.pow, 2): _pow_bits, (builtins.pow, 2): _pow_bits,
+    (operator.mul, 2): _mul_bits, (math.factorial, 1): _factorial_bits,
+}
+if hasattr(math, 'comb'):
+    # python 3.8+
+    _ESTIMATORS.update({
+        (math.comb, 2): _comb_bits, (math.perm, 2): _perm_bits,
+        (math.perm, 1): _factorial_bits,
+    })
+
+
+def _check_bits(bits, max_bits):
+    """
+    Raise BudgetExceeded if bit length is over limit.
+    """
+    if bits > max_bits:
+        raise BudgetExceeded("Integer result is too large: " + str(bits) +
+                             " bits, limit is " + str(max_bits))
+
+
+def run_limited(program, variables, budget, dispatch=_DISPATCH):
+    """
+    Calculate program like program.run() within budget.
+    :param program: Program from assemble()
+    :param variables: values of variables for LOAD instructions
+    :param budget: Budget of evaluation
+    :param dispatch: handlers of UNARY and CALL opcodes
+    :return: Result of calculation
+    """
+    max_bits, max_operations, timeout, _ = budget
+    deadline = None if timeout is None else time.monotonic() + timeout
+    operations = 0
+    stack = []
+    push, pop = stack.append, stack.pop
+    registers = [None] * program.registers
+    code = iter(program.code)
+    try:
+        for opcode, operand, argc in code:
+            if opcode == PUSH:
+                # constant may be folded by optimizer within its
+                # own limits, so it is checked as result of operation
+                if max_bits is not None:
+                    bits = _int_bits(operand)
+                    if bits is not None:
+                        _check_bits(bits, max_bits)
+                push(operand)
+                continue
+            if opcode == LOAD:
+                try:
+                    push(variables[operand])
+                except KeyError:
+                    raise ArithmeticError("Unbound variable:" + operand)
+                continue
+            if opcode == RECALL:
+                push(registers[operand])
+                continue
+            if opcode == STORE:
+                registers[operand] = stack[-1]
+                continue
+            if opcode >= JUMP:
+                _jump(stack, code, opcode, operand)
+                continue
+            operations += 1
+            if max_operations is not None and operations > max_operations:
+                raise BudgetExceeded("Too many operations, limit is " +
+                                     str(max_operations))
+            if deadline is not None and time.monotonic() > deadline:
+                raise BudgetExceeded("Evaluation timed out after " +
+                                     str(timeout) + " seconds")
+            if max_bits is not None:
+                estimate = _ESTIMATORS.get((operand, argc))
+                if estimate is not None:
+                    _check_bits(estimate(*stack[-argc:]), max_bits)
+            if opcode == BINARY:
+                operand_2 = pop()
+                stack[-1] = operand(stack[-1], operand_2)
+            else:
+                dispatch[opcode](stack, operand, argc)
+            if max_bits is not None:
+                bits = _int_bits(stack[-1])
+                if bits is not None:
+                    _check_bits(bits, max_bits)
+    except ZeroDivisionError:
+        raise ArithmeticError("Division by zero")
+    return stack[0]
@@ -0,0 +1,210 @@
+"""
+This module provide closure backend of compiled expressions.
+
+build() turns Program into tree of nested closures: operators, functions
+and constant operands are free variables of closures, so evaluation is
+one call of root closure without stack, loop over instructions and
+dispatch of opcodes. Every closure takes values of variables and list
+of registers, where common subexpressions keep their values for RECALL.
+Jumps of if(), 'and' and 'or' become closures, that call closure of
+the chosen value only.
+
+Evaluation of closure tree is recursive, so programs deeper than
+MAX_DEPTH stay on stack interpreter, that has no limit of nesting.
+"""
+from pycalc.program import (PUSH, LOAD, UNARY, BINARY, CALL, STORE, RECALL,
+                            JUMP, JUMP_IF_FALSE, JUMP_IF_FALSE_OR_POP)
+
+# Max depth of closure tree, it is well below default recursion limit
+MAX_DEPTH = 256
+# Value of node, that is known only at evaluation
+_DYNAMIC = object()
+
+
+def _constant(value):
+    def node(variables, registers):
+        return value
+    return node
+
+
+def _load(name):
+    def node(variables, registers):
+        try:
+            return variables[name]
+        except KeyError:
+            raise ArithmeticError("Unbound variable:" + name)
+    return node
+
+
+def _store(number, operand):
+    def node(variables, registers):
+        value = registers[number] = operand(variables, registers)
+        return value
+    return node
+
+
+def _recall(number):
+    def node(variables, registers):
+        return registers[number]
+    return node
+
+
+def _unary(operator, operand):
+    def node(variables, registers):
+        return operator(operand(variables, registers))
+    return node
+
+
+def _binary(operator, left, right):
+    """
+    Closure of binary operator, constant operand is bound as value.
+    :param left: tuple(closure, value, depth) of left operand
+    :param right: tuple(closure, value, depth) of right operand
+    """
+    (left, left_value, _), (right, right_value, _) = left, right
+    if right_value is not _DYNAMIC:
+        def node(variables, registers):
+            return operator(left(variables, registers), right_value)
+    elif left_value is not _DYNAMIC:
+        def node(variables, registers):
+            return operator(left_value, right(variables, registers))
+    else:
+        def node(variables, registers):
+            return operator(left(variables, registers),
+                            right(variables, registers))
+    return node
+
+
+def _call(function, args):
+    """
+    Closure of function call, calls with up to 2 arguments
+    have their own closures.
+    """
+    if not args:
+        def node(variables, registers):
+            return function()
+    elif len(args) == 1:
+        arg, = args
+
+        def node(variables, registers):
+            return function(arg(variables, registers))
+    elif len(args) == 2:
+        arg_1, arg_2 = args
+
+        def node(variables, registers):
+            return function(arg_1(variables, registers),
+                            arg_2(variables, registers))
+    else:
+        def node(variables, registers):
+            return function(*[arg(variables, registers) for arg in args])
+    return node
+
+
+def _if(condition, value_1, value_2):
+    def node(variables, registers):
+        if condition(variables, registers):
+            return value_1(variables, registers)
+        return value_2(variables, registers)
+    return node
+
+
+def _and(left, right):
+    def node(variables, registers):
+        return left(variables, registers) and right(variables, registers)
+    return node
+
+
+def _or(left, right):
+    def node(variables, registers):
+        return left(variables, registers) or right(variables, registers)
+    return node
+
+
+def _branch(opcode, nodes):
+    """
+    Closure of if(), 'and' or 'or' by opcode of its first jump.
+    """
+    if opcode == JUMP_IF_FALSE:
+        return _if(*nodes)
+    if opcode == JUMP_IF_FALSE_OR_POP:
+        return _and(*nodes)
+    return _or(*nodes)
+
+
+def _node(stack, opcode, operand, argc):
+    """
+    Pop operand nodes of instruction from stack and make its closure.
+    """
+    if opcode == LOAD:
+        return _load(operand)
+    if opcode == RECALL:
+        return _recall(operand)
+    if opcode == STORE:
+        return _store(operand, stack.pop()[0])
+    if opcode == UNARY:
+        return _unary(operand, stack.pop()[0])
+    if opcode == BINARY:
+        right = stack.pop()
+        return _binary(operand, stack.pop(), right)
+    if opcode == CALL:
+        args = [arg for arg, _, _ in stack[len(stack) - argc:]]
+        del stack[len(stack) - argc:]
+        return _call(operand, args)
+    raise ValueError("Unknown opcode:" + str(opcode))
+
+
+def build(program):
+    """
+    Translate Program to closure tree.
+    :param program: Program from assemble()
+    :return: function of values of variables, that calculates program,
+             or None if closure tree is deeper than MAX_DEPTH
+    """
+    # nodes of evaluation stack: tuple(closure, constant value, depth)
+    stack = []
+    # branches waiting for their last value: [index after last value,
+    # opcode of first jump, nodes of ready values]
+    branches = []
+    for index, (opcode, operand, argc) in enumerate(program.code):
+        if opcode >= JUMP:
+            if opcode == JUMP:
+                # first value of if() is ready, second one follows
+                branch = branches[-1]
+            else:
+                branch = [None, opcode, []]
+                branches.append(branch)
+            branch[0] = index + 1 + operand
+            branch[2].append(stack.pop())
+            continue
+        # STORE wraps top node, other instructions consume argc nodes
+        args = stack[len(stack) - (1 if opcode == STORE else argc):]
+        depth = 1 + max((arg[2] for arg in args), default=0)
+        if opcode == PUSH:
+            stack.append((_constant(operand), operand, depth))
+        else:
+            node = _node(stack, opcode, operand, argc)
+            stack.append((node, _DYNAMIC, depth))
+        while branches and branches[-1][0] == index + 1:
+            _, jump, nodes = branches.pop()
+            nodes.append(stack.pop())
+            depth = 1 + max(node[2] for node in nodes)
+            stack.append((_branch(jump, [node[0] for node in nodes]),
+                          _DYNAMIC, depth))
+        if depth > MAX_DEPTH:
+            return None
+    root, = (node for node, _, _ in stack)
+    size = program.registers
+
+    if size:
+        def evaluate(variables):
+            try:
+                return root(variables, [None] * size)
+            except ZeroDivisionError:
+                raise ArithmeticError("Division by zero")
+    else:
+        def evaluate(variables):
+            try:
+                return root(variables, None)
+            except ZeroDivisionError:
+                raise ArithmeticError("Division by zero")
+    return evaluate
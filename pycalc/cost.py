@@ -0,0 +1,206 @@
+"""
+This module provide estimate_cost() function: static cost model of
+expression, that is computed from its postfix queue without evaluation.
+
+Unit of cost is parsing and evaluation of one token. Every token costs
+one unit, nesting depth adds cost of shunting-yard stack, calls cost
+their FUNCTION_WEIGHTS. Integers are tracked by estimated bit length,
+so multiplication, power and factorial of big integers cost as their
+CPython algorithms: Karatsuba multiplication of machine words and
+quadratic division.
+"""
+import math
+
+from collections import deque, namedtuple
+
+from pycalc.rpn_calc import _scan
+
+# Cost of calls of functions by name, other functions cost DEFAULT_WEIGHT
+FUNCTION_WEIGHTS = {
+    'abs': 1, 'round': 1.5, 'max': 1.5, 'min': 1.5, 'sum': 2, 'fsum': 4,
+    'gamma': 2, 'lgamma': 2, 'erf': 2, 'erfc': 2, 'hypot': 2,
+}
+DEFAULT_WEIGHT = 1.5
+# Bits of machine word, smaller integers cost as floats
+_WORD = 64
+# Cost of operation on machine words, measured by bench.cost_accuracy()
+_WORD_COST = 0.003
+# Exponent of Karatsuba multiplication
+_KARATSUBA = math.log2(3)
+# Integers up to this size are calculated exactly to know exponents
+_EXACT_BITS = 64
+# Longer integer literals are estimated by number of digits
+_EXACT_DIGITS = 100
+# Bit length of integers is limited, so cost of 9**9**9 is finite
+_MAX_BITS = 1e15
+
+Cost = namedtuple('Cost', 'total, tokens, depth, bits')
+
+# Value on stack of estimation: bit length of integer or None for
+# other types, value of small integer or None
+_Value = namedtuple('_Value', 'bits, value')
+_FLOAT = _Value(None, None)
+
+
+def _mul_cost(bits_1, bits_2):
+    """
+    Cost of multiplication of integers: longer one by Karatsuba
+    multiplications of pieces of length of shorter one.
+    """
+    small, big = sorted((bits_1 / _WORD, bits_2 / _WORD))
+    return (max(small, 1) ** (_KARATSUBA - 1) * max(big, 1) *
+            _WORD_COST)
+
+
+def _integer(bits, value=None):
+    """
+    Integer value, exact value is kept for small integers only.
+    """
+    bits = min(bits, _MAX_BITS)
+    if value is not None and bits > _EXACT_BITS:
+        value = None
+    return _Value(bits, value)
+
+
+def _power(base, exponent):
+    """
+    Result and cost of integer power by repeated squaring, the last
+    squaring costs the most.
+    """
+    if exponent.value is not None and exponent.value < 0:
+        return _FLOAT, 0
+    bits = base.bits * _number(exponent)
+    value = None
+    if (base.value is not None and exponent.value is not None and
+            bits <= _EXACT_BITS):
+        value = base.value ** exponent.value
+    return _integer(bits, value), 2 * _mul_cost(bits / 2, bits / 2)
+
+
+def _binary(_type, operand_1, operand_2):
+    """
+    Result and cost of binary operator.
+    """
+    if operand_1.bits is None or operand_2.bits is None:
+        if _type in {'PLUS', 'MINUS', 'TIMES', 'POWER', 'DIVIDE',
+                     'FDIVIDE', 'MODULO'}:
+            return _FLOAT, 1
+        return _Value(1, None), 1
+    bits_1, bits_2 = operand_1.bits, operand_2.bits
+    value_1, value_2 = operand_1.value, operand_2.value
+    known = value_1 is not None and value_2 is not None
+    if _type in {'PLUS', 'MINUS'}:
+        value = (value_1 + value_2 if _type == 'PLUS'
+                 else value_1 - value_2) if known else None
+        return (_integer(max(bits_1, bits_2) + 1, value),
+                max(bits_1, bits_2, _WORD) / _WORD * _WORD_COST)
+    if _type == 'TIMES':
+        return (_integer(bits_1 + bits_2,
+                         value_1 * value_2 if known else None),
+                _mul_cost(bits_1, bits_2))
+    if _type == 'POWER':
+        return _power(operand_1, operand_2)
+    if _type in {'FDIVIDE', 'MODULO'}:
+        cost = max(bits_1 / _WORD, 1) * max(bits_2 / _WORD, 1) * _WORD_COST
+        return _integer(bits_1 if _type == 'FDIVIDE' else bits_2), cost
+    if _type == 'DIVIDE':
+        return _FLOAT, _mul_cost(bits_1, bits_2)
+    return _Value(1, None), max(bits_1, bits_2, _WORD) / _WORD * _WORD_COST
+
+
+def _number(arg):
+    """
+    Value of integer argument or its estimate by bit length.
+    """
+    return arg.value if arg.value is not None else 2.0 ** min(arg.bits, 64)
+
+
+def _factorial(arg):
+    """
+    Result and cost of factorial(n): n! has about n*log2(n/e) bits,
+    it is calculated by binary splitting.
+    """
+    if arg.bits is None:
+        return _FLOAT, DEFAULT_WEIGHT
+    n = _number(arg)
+    if n < 2:
+        return _integer(1, 1), DEFAULT_WEIGHT
+    bits = n * max(math.log2(n / math.e), 1)
+    return (_integer(bits), DEFAULT_WEIGHT +
+            _mul_cost(bits / 2, bits / 2) * math.log2(n) / 2)
+
+
+def _call(name, args):
+    """
+    Result and cost of call of function.
+    """
+    if name == 'factorial' and len(args) == 1:
+        return _factorial(args[0])
+    if name in {'comb', 'perm'} and args and args[0].bits is not None:
+        # comb(n, k) has at most n bits and costs about as n!
+        _, cost = _factorial(args[0])
+        return _integer(max(_number(args[0]), 1)), cost
+    return _FLOAT, FUNCTION_WEIGHTS.get(name, DEFAULT_WEIGHT)
+
+
+def _estimate(token, stack):
+    """
+    Pop operands of token from stack.
+    :return: tuple(result, cost of token besides its unit)
+    """
+    _type = token.type
+    if _type == 'INTEGER':
+        if len(token.value) > _EXACT_DIGITS:
+            # int() of long literal is slow or over limit of digits
+            return _integer(len(token.value) * math.log2(10)), 0
+        value = int(token.value)
+        return _integer(value.bit_length(), value), 0
+    if _type in {'FLOAT', 'COMPLEX', 'CONST'}:
+        return _FLOAT, 0
+    if _type in {'COMMA', 'ARGS'}:
+        return token.value, 0
+    if _type in {'FUNC', 'IF'}:
+        args = deque()
+        for number in range(stack.pop()):
+            if number:
+                stack.pop()
+            args.appendleft(stack.pop())
+        if _type == 'IF':
+            # both values are counted, only one of them is calculated
+            bits = [arg.bits for arg in args if arg.bits is not None]
+            return (_integer(max(bits)) if bits else _FLOAT), 0
+        return _call(token.value[:-1].split('.')[-1], list(args))
+    if _type in {'UMINUS', 'UPLUS'}:
+        operand = stack.pop()
+        if _type == 'UMINUS' and operand.value is not None:
+            return operand._replace(value=-operand.value), 0
+        return operand, 0
+    operand_2, operand_1 = stack.pop(), stack.pop()
+    return _binary(_type, operand_1, operand_2)
+
+
+def estimate_cost(expr):
+    """
+    Estimate cost of calculation of expression without evaluation.
+    :param expr: EXPRESSION for calculation
+    :type expr: str
+    :return: Cost(total, tokens, depth, bits), total is in units of
+             one token, depth is max depth of evaluation stack,
+             bits is estimated bit length of the largest integer
+    :raise ArithmeticError: if expression can't be parsed
+    """
+    queue = _scan(expr)
+    stack = deque()
+    total, depth, max_bits = 0.0, 0, 0
+    for token in queue:
+        try:
+            result, cost = _estimate(token, stack)
+        except (IndexError, TypeError, AttributeError):
+            # malformed queue, like 1 +
+            raise ArithmeticError("Calculation error")
+        stack.append(result)
+        depth = max(depth, len(stack))
+        if isinstance(result, _Value) and result.bits is not None:
+            max_bits = max(max_bits, result.bits)
+        total += 1 + cost
+    return Cost(total + depth, len(queue), depth, max_bits)
@@ -3,21 +3,132 @@ This module import external modules and
 find attributes(functions and constants) in this external modules
 """
 
+import builtins
+import importlib.util
+import math
 import sys
+import threading
+
+
+class Namespace:
+    """
+    Resolved names of imported modules.
+
+    Top-level names of all modules are collected in one flat dict index,
+    name from the module earlier in list overrides the same name from
+    later modules. Dotted names are resolved once and cached in index.
+
+    Modules are only checked to exist when namespace is created, they are
+    imported and indexed on first lookup of name, so expressions
+    without names don't pay for import of additional modules.
+    """
+
+    def __init__(self, module_names):
+        self.modules = tuple(module_names)
+        for module in self.modules:
+            if module in sys.modules:
+                continue
+            try:
+                spec = importlib.util.find_spec(module)
+            except (ImportError, ValueError):
+                spec = None
+            if spec is None:
+                raise ImportError("Module not found:" + module)
+        self._imported = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Import modules and build index of their names.
+        """
+        with self._lock:
+            if self._index is not None:
+                return
+            imported = {}
+            for module in self.modules:
+                try:
+                    imported[module] = __import__(module)
+                except ImportError:
+                    raise ImportError("Module not found:" + module)
+            index = {}
+            for module in reversed(self.modules):
+                module = sys.modules[module]
+                for name in dir(module):
+                    attr = getattr(module, name, None)
+                    if attr is not None:
+                        index[name] = attr
+            self._imported = imported
+            self._index = index
+
+    def __repr__(self):
+        return '<Namespace modules={!r}>'.format(self.modules)
+
+    def find(self, attr_name):
+        """
+        Find attribute in modules of namespace, see find_attr().
+        :param attr_name: Name of searching attribute
+        :return: Object of attribute
+        """
+        if self._index is None:
+            self._load()
+        try:
+            return self._index[attr_name]
+        except KeyError:
+            attr = self._find_path(attr_name)
+            self._index[attr_name] = attr
+            return attr
+
+    def _find_path(self, attr_name):
+        """
+        Find attribute that is missing in index by getattr() calls.
+        """
+        attr_name = attr_name.split('.')
+        if len(attr_name) == 1:
+            for module in self.modules:
+                attr = getattr(sys.modules[module], attr_name[0], None)
+                if attr is not None:
+                    return attr
+        elif attr_name[0] in self._imported:
+            attr = self._imported[attr_name[0]]
+            for part in attr_name[1:]:
+                attr = getattr(attr, part, None)
+            if attr is not None:
+                return attr
+        raise ArithmeticError("Unknown function or constant:" +
+                              str(attr_name))
+
+
+# Namespaces of already used module sets: tuple(modules) -> Namespace
+_namespaces = {}
+_namespaces_lock = threading.Lock()
+
+
+def get_namespace(_modules):
+    """
+    Return Namespace of modules, that is built once per module set.
+    :param _modules: names of modules in priority order
+    :return: Namespace object
+    """
+    key = tuple(_modules)
+    namespace = _namespaces.get(key)
+    if namespace is None:
+        with _namespaces_lock:
+            namespace = _namespaces.get(key)
+            if namespace is None:
+                namespace = _namespaces[key] = Namespace(key)
+    return namespace
 
 
 def import_modules(_modules):
     """
-    Import _modules in global namespace
+    Import _modules and use them in find_attr().
+    It changes module state, use Calculator or Namespace in threads.
     :return:
     """
-    global modules
-    modules = _modules
-    for module in _modules:
-        try:
-            globals()[module] = __import__(module)
-        except ImportError:
-            raise ImportError("Module not found:" + module)
+    global modules, _namespace
+    _namespace = get_namespace(_modules)
+    modules = _namespace.modules
 
 
 def find_attr(attr_name):
@@ -31,18 +142,35 @@ def find_attr(attr_name):
     :param attr_name: Name of searching attribute
     :return: Object of attribute
     """
-    attr_name = attr_name.split('.')
-    if len(attr_name) == 1:
-        for module in modules:
-            attr = getattr(sys.modules[module], attr_name[0], None)
-            if attr is None:
-                continue
-            return attr
-    else:
-        if attr_name[0] in modules:
-            attr = getattr(sys.modules[__name__], attr_name[0], None)
-            for part in attr_name[1:]:
-                attr = getattr(attr, part, None)
-            if attr is not None:
-                return attr
-    raise ArithmeticError("Unknown function or constant:" + str(attr_name))
+    return _namespace.find(attr_name)
+
+
+# Functions without side effects: result depends only on arguments,
+# so calls with the same arguments can be calculated once
+PURE_FUNCTIONS = {
+    attr for attr in vars(math).values() if callable(attr)
+} | {
+    getattr(builtins, name) for name in (
+        'abs', 'all', 'any', 'bool', 'complex', 'divmod', 'float', 'int',
+        'len', 'max', 'min', 'pow', 'range', 'round', 'sum')
+}
+
+
+def pure(function):
+    """
+    Decorator that marks function from user module as pure.
+    :param function: function without side effects
+    :return: the same function
+    """
+    PURE_FUNCTIONS.add(function)
+    return function
+
+
+def is_pure(function):
+    """
+    Check that function is marked as pure.
+    """
+    try:
+        return function in PURE_FUNCTIONS
+    except TypeError:
+        return False
@@ -0,0 +1,258 @@
+"""
+This module provide instrumentation of calc() and compiled expressions.
+
+Recorder collects wall time of calculation stages (scan, modify,
+tokenize, unary, postfix, evaluate), token counts, stack depth and number
+of calls of every resolved function. Recorders are active while registered
+with add_recorder() or inside recording() block; when no recorder is
+registered, calc() pays only for one check of empty list.
+"""
+import bisect
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+from pycalc.budget import run_limited
+from pycalc.program import run, CALL, _DISPATCH
+
+# Upper bounds of time histogram buckets: 1us, 2us, 4us ... ~67s
+TIME_BUCKETS = tuple(1e-6 * 2 ** i for i in range(27))
+# Upper bounds of token count and stack depth histogram buckets
+SIZE_BUCKETS = tuple(2 ** i for i in range(25))
+
+STAGES = ('scan', 'modify', 'tokenize', 'unary', 'postfix', 'evaluate')
+
+# Registered recorders, rpn_calc checks this list on hot path
+_recorders = []
+
+
+class _Histogram:
+    """
+    Histogram with fixed bucket bounds and summary values.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = self.max = None
+
+    def add(self, value):
+        """Add one observation."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        """
+        :return: dict with count, total, min, max and non-empty buckets
+                 as list of [upper bound, count], last bound is None
+        """
+        bounds = self.bounds + (None,)
+        return {
+            'count': self.count, 'total': self.total,
+            'min': self.min, 'max': self.max,
+            'buckets': [[bounds[i], count]
+                        for i, count in enumerate(self.counts) if count],
+        }
+
+
+def symbol_name(function):
+    """
+    Qualified name of resolved function, like 'math.sin'.
+    """
+    module = getattr(function, '__module__', None)
+    name = getattr(function, '__qualname__', None) or repr(function)
+    return name if module in (None, 'builtins') else module + '.' + name
+
+
+class Recorder:
+    """
+    Thread-safe collector of calculation metrics.
+
+    Subclass it and override on_stage(), on_tokens() or on_evaluate()
+    to export metrics as they come.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Remove all collected metrics."""
+        with self._lock:
+            self._stages = {stage: _Histogram(TIME_BUCKETS)
+                            for stage in STAGES}
+            self._tokens = _Histogram(SIZE_BUCKETS)
+            self._stack = _Histogram(SIZE_BUCKETS)
+            self._calls = Counter()
+
+    def on_stage(self, stage, seconds):
+        """Called with wall time of every finished stage."""
+        with self._lock:
+            self._stages[stage].add(seconds)
+
+    def on_tokens(self, count):
+        """Called with number of tokens of every parsed expression."""
+        with self._lock:
+            self._tokens.add(count)
+
+    def on_evaluate(self, stack_depth, calls):
+        """
+        Called after every evaluation.
+        :param stack_depth: max depth of calculation stack
+        :param calls: Counter of called functions
+        """
+        with self._lock:
+            self._stack.add(stack_depth)
+            self._calls.update(calls)
+
+    def snapshot(self):
+        """
+        Aggregated metrics collected so far.
+        :return: JSON-serializable dict
+        """
+        with self._lock:
+            calls = Counter()
+            for function, count in self._calls.items():
+                calls[symbol_name(function)] += count
+            return {
+                'stages': {stage: histogram.snapshot()
+                           for stage, histogram in self._stages.items()},
+                'tokens': self._tokens.snapshot(),
+                'stack_depth': self._stack.snapshot(),
+                'calls': dict(calls),
+            }
+
+
+def merge_snapshots(*snapshots):
+    """
+    Aggregate snapshots of several recorders, e.g. from worker processes.
+    :return: snapshot of all observations
+    """
+    def merge(histograms):
+        histograms = [h for h in histograms if h['count']]
+        buckets = Counter()
+        for histogram in histograms:
+            for bound, count in histogram['buckets']:
+                buckets[bound] += count
+        return {
+            'count': sum(h['count'] for h in histograms),
+            'total': sum(h['total'] for h in histograms),
+            'min': min((h['min'] for h in histograms), default=None),
+            'max': max((h['max'] for h in histograms), default=None),
+            'buckets': sorted(([b, c] for b, c in buckets.items()),
+                              key=lambda item: (item[0] is None, item[0])),
+        }
+
+    calls = Counter()
+    for snapshot in snapshots:
+        calls.update(snapshot['calls'])
+    return {
+        'stages': {stage: merge(s['stages'][stage] for s in snapshots)
+                   for stage in STAGES},
+        'tokens': merge(s['tokens'] for s in snapshots),
+        'stack_depth': merge(s['stack_depth'] for s in snapshots),
+        'calls': dict(calls),
+    }
+
+
+def add_recorder(recorder):
+    """Register recorder for all following calculations."""
+    _recorders.append(recorder)
+
+
+def remove_recorder(recorder):
+    """Unregister recorder."""
+    _recorders.remove(recorder)
+
+
+@contextmanager
+def recording(recorder=None):
+    """
+    Context manager that registers recorder for the block.
+    :param recorder: Recorder, new one if None
+    :return: recorder
+    """
+    recorder = Recorder() if recorder is None else recorder
+    add_recorder(recorder)
+    try:
+        yield recorder
+    finally:
+        remove_recorder(recorder)
+
+
+class _StageTimer:
+    """
+    Measures consecutive stages and reports them to recorders.
+    """
+
+    def __init__(self, recorders):
+        self._recorders = recorders
+        self._start = time.perf_counter()
+
+    def lap(self, stage):
+        """Finish stage, that started at previous lap."""
+        now = time.perf_counter()
+        for recorder in self._recorders:
+            recorder.on_stage(stage, now - self._start)
+        self._start = time.perf_counter()
+
+    def tokens(self, count):
+        """Report number of tokens."""
+        for recorder in self._recorders:
+            recorder.on_tokens(count)
+
+
+class _NullTimer:
+    """
+    Timer used when no recorder is registered.
+    """
+
+    def lap(self, stage):
+        """Do nothing."""
+
+    def tokens(self, count):
+        """Do nothing."""
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def stage_timer():
+    """
+    :return: timer of parsing stages for registered recorders
+    """
+    return _StageTimer(tuple(_recorders)) if _recorders else _NULL_TIMER
+
+
+def instrumented_run(program, variables, budget=None, dispatch=_DISPATCH):
+    """
+    Calculate program like program.run() or budget.run_limited() and
+    report evaluation time, stack depth and function calls to registered
+    recorders.
+    """
+    recorders = tuple(_recorders)
+    calls = Counter()
+    call = dispatch[CALL]
+
+    def counted_call(stack, function, argc):
+        calls[function] += 1
+        call(stack, function, argc)
+
+    dispatch = dispatch[:CALL] + (counted_call,) + dispatch[CALL + 1:]
+    start = time.perf_counter()
+    try:
+        if budget is not None:
+            return run_limited(program, variables, budget, dispatch)
+        return run(program, variables, dispatch)
+    finally:
+        seconds = time.perf_counter() - start
+        for recorder in recorders:
+            recorder.on_stage('evaluate', seconds)
+            recorder.on_evaluate(program.stack_size, calls)
@@ -0,0 +1,111 @@
+"""
+This module provide memoization of calls of pure functions during
+evaluation of compiled expressions.
+
+Memo keeps bounded LRU cache for every pure function, see
+ext_modules.pure() and PURE_FUNCTIONS, and is plugged into evaluation
+as handler of CALL opcode. Arguments are cached with their types,
+so 1 and 1.0 or 0.0 and -0.0 are different keys; calls with unhashable
+arguments bypass cache.
+"""
+import threading
+
+from pycalc.ext_modules import is_pure
+from pycalc.instrument import symbol_name
+from pycalc.program import CALL, _DISPATCH, _call
+from pycalc.rpn_calc import _LRUCache
+
+# Cached None result, None is returned by cache on miss
+_NONE = object()
+
+
+def _arg_key(arg):
+    """
+    Key of argument, that tells apart values of different types
+    and signed zeros.
+    """
+    kind = type(arg)
+    if kind in (float, complex) and arg == 0:
+        return kind, repr(arg)
+    return kind, arg
+
+
+class Memo:
+    """
+    Caches of results of pure functions, one LRU cache per function.
+    """
+
+    def __init__(self, maxsize=256):
+        """
+        :param maxsize: max number of results of one function
+        """
+        self.maxsize = maxsize
+        self.unhashable = 0
+        self._caches = {}
+        self._lock = threading.Lock()
+        self.dispatch = _DISPATCH[:CALL] + (self.call,) + _DISPATCH[CALL + 1:]
+
+    def _cache(self, function):
+        """
+        Return cache of function, create it on first call.
+        """
+        cache = self._caches.get(function)
+        if cache is None:
+            with self._lock:
+                cache = self._caches.setdefault(function,
+                                                _LRUCache(self.maxsize))
+        return cache
+
+    def call(self, stack, function, argc):
+        """
+        Handler of CALL opcode, that looks up result of pure function
+        in cache before calling it.
+        """
+        if not is_pure(function):
+            _call(stack, function, argc)
+            return
+        args = stack[-argc:] if argc else []
+        key = tuple(_arg_key(arg) for arg in args)
+        try:
+            hash(key)
+        except TypeError:
+            with self._lock:
+                self.unhashable += 1
+            _call(stack, function, argc)
+            return
+        cache = self._cache(function)
+        value = cache.get(key)
+        if value is None:
+            value = function(*args)
+            cache.put(key, _NONE if value is None else value)
+        elif value is _NONE:
+            value = None
+        if argc:
+            del stack[-argc:]
+        stack.append(value)
+
+    def info(self):
+        """
+        :return: dict of qualified function name and its _CacheInfo
+        """
+        with self._lock:
+            caches = list(self._caches.items())
+        return {symbol_name(function): cache.info()
+                for function, cache in caches}
+
+    def hit_rate(self):
+        """
+        :return: share of calls of pure functions, that were cache hits
+        """
+        infos = self.info().values()
+        hits = sum(info.hits for info in infos)
+        calls = hits + sum(info.misses for info in infos)
+        return hits / calls if calls else 0.0
+
+    def clear(self):
+        """
+        Remove all cached results and reset counters.
+        """
+        with self._lock:
+            self._caches.clear()
+            self.unhashable = 0
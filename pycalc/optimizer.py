@@ -0,0 +1,437 @@
+"""
+This module provide optimize() function for postfix queue of compiled
+expression: constant folding and safe algebraic simplification,
+specialize() function for partial evaluation of queue on values of some
+variables, and eliminate_common() function for Program: elimination of
+common subexpressions.
+"""
+import math
+import operator
+
+from collections import Counter, deque, namedtuple
+
+from pycalc.budget import Budget, run_limited
+from pycalc.ext_modules import is_pure
+from pycalc.memo import _arg_key
+from pycalc.program import (assemble, Program, PUSH, CALL, STORE,
+                            RECALL, JUMP)
+from pycalc.rpn_calc import _Token, _and, _or
+
+# Known kinds of values: the larger kind is the narrower type.
+# Identities are applied only where they keep value and type of result.
+_UNKNOWN, _NUMBER, _REAL, _INTEGER = range(4)
+
+# Math functions, that may return not a real number
+_NOT_REAL_MATH = {'ceil', 'floor', 'trunc', 'prod', 'frexp', 'modf'}
+
+# Limits of folding, larger or slower constants are left
+# to evaluation, where budget of calculator applies
+FOLD_BUDGET = Budget(max_bits=4096, max_operations=10000)
+
+# Subtree of expression: postfix tokens of subtree are out[start:end],
+# is it constant, kind of value, and type of COMMA or ARGS marker
+_Node = namedtuple('_Node', 'start, const, kind, marker')
+
+
+def _value_kind(value):
+    """
+    Kind of constant value.
+    """
+    if type(value) is int:
+        return _INTEGER
+    if type(value) is float:
+        return _REAL
+    if type(value) is complex:
+        return _NUMBER
+    return _UNKNOWN
+
+
+def _literal_kind(token):
+    """
+    Kind of literal token.
+    """
+    if token.type == 'INTEGER':
+        return _INTEGER
+    if token.type == 'FLOAT':
+        return _REAL
+    if token.type == 'COMPLEX':
+        return _NUMBER
+    return _value_kind(token.value)
+
+
+def _is_literal(out, node, end, number):
+    """
+    Check that node out[node.start:end] is integer literal equal to number.
+    """
+    if end - node.start != 1 or node.kind != _INTEGER:
+        return False
+    token = out[node.start]
+    return token.operator(token.value) == number
+
+
+def _call_kind(function):
+    """
+    Kind of function result, math functions return real numbers.
+    """
+    name = getattr(function, '__name__', '')
+    if (getattr(function, '__module__', None) == 'math' and
+            getattr(math, name, None) is function and
+            not name.startswith('is') and name not in _NOT_REAL_MATH):
+        return _REAL
+    return _UNKNOWN
+
+
+def _binary_kind(function, kind_1, kind_2):
+    """
+    Kind of result of binary operator.
+    """
+    kind = min(kind_1, kind_2)
+    if function in (operator.add, operator.sub, operator.mul,
+                    operator.floordiv, operator.mod):
+        return kind
+    if function is operator.truediv:
+        return min(kind, _REAL)
+    if function is operator.pow:
+        return _REAL if kind == _INTEGER else min(kind, _NUMBER)
+    return _UNKNOWN
+
+
+def _simplify(out, operand_1, operand_2, function):
+    """
+    Apply identity x*1, 1*x, x**1, x-0 for real x and x+0, 0+x for
+    integer x: they don't change value or type of x.
+    Tokens of literal are removed from out.
+    :return: node of x or None if no identity matches
+    """
+    end = len(out)
+    if function in (operator.mul, operator.pow, operator.sub):
+        number = 0 if function is operator.sub else 1
+        if (operand_1.kind >= _REAL and
+                _is_literal(out, operand_2, end, number)):
+            del out[operand_2.start:]
+            return operand_1
+    if function in (operator.mul, operator.add):
+        kind = _REAL if function is operator.mul else _INTEGER
+        number = 1 if function is operator.mul else 0
+        if (operand_1.kind >= kind and
+                _is_literal(out, operand_2, end, number)):
+            del out[operand_2.start:]
+            return operand_1
+        if (operand_2.kind >= kind and
+                _is_literal(out, operand_1, operand_2.start, number)):
+            del out[operand_1.start]
+            return operand_2._replace(start=operand_1.start)
+    return None
+
+
+def _fold(out, start, kind):
+    """
+    Calculate constant subtree out[start:] and replace it with VALUE token.
+    Subtree that fails to calculate or exceeds FOLD_BUDGET is left as is,
+    so its error is raised on evaluation.
+    """
+    if len(out) - start == 1:
+        return _Node(start, True, kind, None)
+    try:
+        value = run_limited(assemble(out[start:]), None, FOLD_BUDGET)
+    except Exception:
+        return _Node(start, False, kind, None)
+    index = out[-1].index
+    del out[start:]
+    out.append(_Token(index, 'VALUE', value))
+    return _Node(start, True, _value_kind(value), None)
+
+
+def _truth(out, node):
+    """
+    Truth of constant node, None if value has no truth like numpy array.
+    """
+    token = out[node.start]
+    try:
+        return bool(token.operator(token.value))
+    except Exception:
+        return None
+
+
+def _choose(out, start, node, end):
+    """
+    Replace subtree out[start:] with its value out[node.start:end],
+    that is chosen by constant condition.
+    """
+    tokens = out[node.start:end]
+    del out[start:]
+    out.extend(tokens)
+    return node._replace(start=start)
+
+
+def optimize(queue):
+    """
+    Fold every constant subtree of postfix queue into one VALUE token.
+
+    Subtree is constant if it consists of literals, bound constants,
+    operators and calls of pure functions. Safe identities like x*1 are
+    simplified too, if(), 'and' and 'or' with constant condition are
+    replaced with the chosen value. Queue must be bound to namespace, see
+    CompiledExpression. Malformed queue is returned unchanged.
+
+    :param queue: postfix queue with VALUE, CALL and VAR tokens
+    :return: tuple(optimized queue, number of removed tokens)
+    """
+    out, stack = [], deque()
+    try:
+        for token in queue:
+            start = len(out)
+            if token.type in ('FUNC', 'CONST'):
+                return queue, 0
+            elif token.type in ('FLOAT', 'INTEGER', 'COMPLEX', 'VALUE'):
+                out.append(token)
+                stack.append(_Node(start, True, _literal_kind(token), None))
+            elif token.type in ('VAR', 'COMMA', 'ARGS'):
+                out.append(token)
+                marker = None if token.type == 'VAR' else token.type
+                stack.append(_Node(start, False, _UNKNOWN, marker))
+            elif token.type in ('CALL', 'IF'):
+                args_node = stack.pop()
+                if args_node.marker != 'ARGS':
+                    return queue, 0
+                args = []
+                for number in range(out[args_node.start].value):
+                    if number and stack.pop().marker != 'COMMA':
+                        return queue, 0
+                    args.append(stack.pop())
+                start = args[-1].start if args else args_node.start
+                if (token.type == 'IF' and len(args) == 3 and
+                        not all(arg.const for arg in args) and
+                        args[2].const and
+                        _truth(out, args[2]) is not None):
+                    value_2, value_1, condition = args
+                    if _truth(out, condition):
+                        # value_1 ends before COMMA
+                        node = _choose(out, start, value_1,
+                                       value_2.start - 1)
+                    else:
+                        node = _choose(out, start, value_2, args_node.start)
+                    stack.append(node)
+                    continue
+                out.append(token)
+                if token.type == 'IF':
+                    # if() of constants is folded, it calculates
+                    # only the chosen value
+                    kind, pure = _UNKNOWN, True
+                else:
+                    kind, pure = _call_kind(token.value), is_pure(token.value)
+                if pure and all(arg.const for arg in args):
+                    stack.append(_fold(out, start, kind))
+                else:
+                    stack.append(_Node(start, False, kind, None))
+            elif token.type in ('UMINUS', 'UPLUS'):
+                operand = stack.pop()
+                out.append(token)
+                if operand.const:
+                    stack.append(_fold(out, operand.start, operand.kind))
+                else:
+                    stack.append(operand)
+            else:
+                operand_2, operand_1 = stack.pop(), stack.pop()
+                kind = _binary_kind(token.operator, operand_1.kind,
+                                    operand_2.kind)
+                if operand_1.const and operand_2.const:
+                    out.append(token)
+                    stack.append(_fold(out, operand_1.start, kind))
+                    continue
+                truth = (_truth(out, operand_1) if operand_1.const and
+                         token.operator in (_and, _or) else None)
+                if truth is not None:
+                    # true 'and' and false 'or' give right operand
+                    if truth == (token.operator is _and):
+                        node = _choose(out, operand_1.start, operand_2,
+                                       len(out))
+                    else:
+                        node = _choose(out, operand_1.start, operand_1,
+                                       operand_2.start)
+                    stack.append(node)
+                    continue
+                node = _simplify(out, operand_1, operand_2, token.operator)
+                if node is None:
+                    out.append(token)
+                    node = _Node(operand_1.start, False, kind, None)
+                stack.append(node)
+    except IndexError:
+        return queue, 0
+    return deque(out), len(queue) - len(out)
+
+
+def specialize(queue, bindings):
+    """
+    Partially evaluate postfix queue: VAR tokens of bound variables
+    become VALUE tokens, so optimize() folds every subtree, that depends
+    only on them, and keeps only chosen values of if(), 'and' and 'or'
+    with bound condition.
+
+    :param queue: postfix queue with VALUE, CALL and VAR tokens
+    :param bindings: values of some variables, extra names are ignored
+    :type bindings: dict
+    :return: tuple(specialized queue, number of removed tokens)
+    """
+    bound = deque(_Token(token.index, 'VALUE', bindings[token.value])
+                  if token.type == 'VAR' and token.value in bindings
+                  else token for token in queue)
+    out, _ = optimize(bound)
+    return out, len(queue) - len(out)
+
+
+def _operand_key(opcode, operand):
+    """
+    Hashable key of instruction operand, unhashable values
+    are compared by identity.
+    """
+    if opcode == PUSH:
+        operand = _arg_key(operand)
+    try:
+        hash(operand)
+    except TypeError:
+        return id(operand)
+    return operand
+
+
+def _dominating(stored, path):
+    """
+    Find register of subexpression, that is stored on every path
+    to instruction: outside of branches of instruction or in its branch.
+    :param stored: list of tuples(register, branch path of STORE)
+    :param path: branch path of instruction
+    :return: register or None
+    """
+    for register, store_path in stored:
+        if path[:len(store_path)] == store_path:
+            return register
+    return None
+
+
+def _drop_stores(out, recalled):
+    """
+    Drop STORE instructions of registers, that are never recalled,
+    renumber registers and fix offsets of jumps over dropped ones.
+    """
+    numbers = {register: number
+               for number, register in enumerate(sorted(recalled))}
+    # new positions of instructions and of end of code
+    positions, count = [], 0
+    for opcode, operand, _ in out:
+        positions.append(count)
+        if opcode != STORE or operand in recalled:
+            count += 1
+    positions.append(count)
+    code = []
+    for position, (opcode, operand, argc) in enumerate(out):
+        if opcode == STORE and operand not in recalled:
+            continue
+        if opcode in (STORE, RECALL):
+            operand = numbers[operand]
+        elif opcode >= JUMP:
+            operand = (positions[position + 1 + operand] -
+                       positions[position] - 1)
+        code.append((opcode, operand, argc))
+    return code, len(numbers)
+
+
+def eliminate_common(program):
+    """
+    Calculate every repeated subexpression of program only once:
+    first occurrence stores its value in register, the rest recall it.
+
+    Subexpression is eliminated if it has variables, operators or
+    calls of pure functions only, so it gives the same value every time.
+    Values of if(), 'and' and 'or' are not eliminated, subexpression
+    inside their branches recalls only register, that is stored on every
+    path to it.
+    :param program: Program from assemble()
+    :return: Program with STORE and RECALL instructions
+    """
+    code = program.code
+    # start of subtree, its key and branch path for every instruction;
+    # branch path is tuple of indexes of jumps, that start branches
+    starts, keys, paths = [], [], []
+    # instructions whose subtrees start at index
+    subtrees = [[] for _ in code]
+    # values on stack: tuple(start, key)
+    stack = []
+    # key of subtree is small int, that is given to distinct tuple of
+    # instruction and keys of its children on first sight, so keys of
+    # deep subtrees are hashed in constant time
+    interned = {}
+    # open branches: [index after last value, start of first value]
+    branches = []
+    path = ()
+    for index, (opcode, operand, argc) in enumerate(code):
+        starts.append(index)
+        keys.append(None)
+        paths.append(path)
+        if opcode >= JUMP:
+            value_start = stack.pop()[0]
+            if opcode == JUMP:
+                # second value of if() is the other branch
+                branch = branches[-1]
+                path = path[:-1]
+            else:
+                branch = [None, value_start]
+                branches.append(branch)
+            branch[0] = index + 1 + operand
+            path += (index,)
+            continue
+        children = stack[len(stack) - argc:]
+        del stack[len(stack) - argc:]
+        start = children[0][0] if children else index
+        pure = (all(key is not None for _, key in children) and
+                (opcode != CALL or is_pure(operand)))
+        if pure:
+            keys[index] = interned.setdefault(
+                (opcode, _operand_key(opcode, operand), argc,
+                 tuple(key for _, key in children)), len(interned))
+        starts[index] = start
+        subtrees[start].append(index)
+        stack.append((start, keys[index]))
+        while branches and branches[-1][0] == index + 1:
+            _, start = branches.pop()
+            stack[-1] = (start, None)
+            path = path[:-1]
+    counts = Counter(key for index, key in enumerate(keys)
+                     if key is not None and starts[index] < index)
+    if not any(count > 1 for count in counts.values()):
+        return program
+    # key -> list of tuples(register, branch path of STORE)
+    registers = {}
+    stored = 0
+    out = []
+    # index of target of jump -> positions of jumps in out
+    jumps = {}
+    index = 0
+    while index < len(code):
+        # recall the largest stored subtree, that starts here
+        for end in reversed(subtrees[index]):
+            register = _dominating(registers.get(keys[end], ()),
+                                   paths[index])
+            if register is not None:
+                out.append((RECALL, register, 0))
+                index = end + 1
+                break
+        else:
+            opcode, operand, argc = code[index]
+            out.append(code[index])
+            key = keys[index]
+            if opcode >= JUMP:
+                jumps.setdefault(index + 1 + operand, []).append(
+                    len(out) - 1)
+            elif counts.get(key, 0) > 1:
+                registers.setdefault(key, []).append((stored, paths[index]))
+                out.append((STORE, stored, 0))
+                stored += 1
+            index += 1
+        # jumps land after code of skipped values
+        for position in jumps.pop(index, ()):
+            opcode, _, argc = out[position]
+            out[position] = (opcode, len(out) - position - 1, argc)
+    recalled = {operand for opcode, operand, _ in out if opcode == RECALL}
+    out, size = _drop_stores(out, recalled)
+    opcodes, operands, argcounts = zip(*out)
+    return Program(opcodes, operands, argcounts, program.stack_size, size)
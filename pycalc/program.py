@@ -0,0 +1,228 @@
+"""
+This module provide compact program form of postfix queue and
+evaluator, that runs program with dispatch table of opcodes.
+
+Program is made of parallel arrays: integer opcodes, operands
+(values, names of variables, operators and functions) and explicit
+argument counts, so evaluation needs no type checks of tokens,
+no sentinel values of function arguments and no name lookups.
+STORE and RECALL opcodes keep value of common subexpression
+in register, so it is calculated only once.
+
+if(), 'and' and 'or' are compiled to forward jumps over instructions
+of values, that are not needed: operand of jump is number of skipped
+instructions, so code of value can be moved without changes.
+"""
+from collections import deque
+from itertools import islice
+
+# Opcodes of program
+PUSH, LOAD, UNARY, BINARY, CALL, STORE, RECALL = range(7)
+# Opcodes of jumps, they are larger than opcodes of values
+JUMP, JUMP_IF_FALSE, JUMP_IF_TRUE_OR_POP, JUMP_IF_FALSE_OR_POP = range(7, 11)
+
+
+class Program:
+    """
+    Compiled expression as parallel arrays of opcodes,
+    operands and argument counts.
+    """
+    __slots__ = ('opcodes', 'operands', 'argcounts', 'stack_size',
+                 'registers', 'code')
+
+    def __init__(self, opcodes, operands, argcounts, stack_size,
+                 registers=0):
+        self.opcodes = tuple(opcodes)
+        self.operands = tuple(operands)
+        self.argcounts = tuple(argcounts)
+        self.stack_size = stack_size
+        # number of registers for STORE and RECALL
+        self.registers = registers
+        # instructions for evaluation loop
+        self.code = tuple(zip(self.opcodes, self.operands, self.argcounts))
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __repr__(self):
+        return '<Program of {} instructions>'.format(len(self))
+
+
+def assemble(queue):
+    """
+    Translate postfix queue to Program.
+
+    Argument separators and ARGS flags are consumed at assembling
+    time, calculation stack is checked to be consistent,
+    so errors of expression structure are raised here.
+    if(c, a, b) is compiled to c JUMP_IF_FALSE a JUMP b,
+    a and b to a JUMP_IF_FALSE_OR_POP b, a or b to a JUMP_IF_TRUE_OR_POP b.
+    :param queue: postfix queue bound to namespace, see CompiledExpression
+    :return: Program
+    """
+    opcodes, operands, argcounts = [], [], []
+    # Items of calculation stack: None for value, ',' for separator
+    # and number of arguments for ARGS, and index of first instruction
+    # of every item
+    stack, starts = deque(), deque()
+    # depth of calculation stack at run time and its maximum
+    depth = stack_size = 0
+
+    def pop_value():
+        if not stack or stack[-1] is not None:
+            raise ArithmeticError("Calculation error")
+        stack.pop()
+        return starts.pop()
+
+    def insert_jump(index, opcode, offset):
+        opcodes.insert(index, opcode)
+        operands.insert(index, offset)
+        argcounts.insert(index, 0)
+
+    for token in queue:
+        start = len(opcodes)
+        if token.type in ('FLOAT', 'INTEGER', 'COMPLEX', 'VALUE'):
+            opcode, operand, argc = PUSH, token.operator(token.value), 0
+        elif token.type == 'VAR':
+            opcode, operand, argc = LOAD, token.value, 0
+        elif token.type in ('COMMA', 'ARGS'):
+            stack.append(',' if token.type == 'COMMA' else token.value)
+            starts.append(start)
+            continue
+        elif token.type == 'UPLUS':
+            # unary plus returns its operand unchanged
+            starts.append(pop_value())
+            stack.append(None)
+            continue
+        elif token.type == 'UMINUS':
+            start = pop_value()
+            opcode, operand, argc = UNARY, token.operator, 1
+        elif token.type in ('CALL', 'IF'):
+            if not stack or stack[-1] in (None, ','):
+                raise ArithmeticError("Calculation error")
+            starts.pop()
+            # start indexes of arguments from last to first
+            args = []
+            for number in range(stack.pop()):
+                if number:
+                    if not stack or stack[-1] != ',':
+                        raise ArithmeticError("Calculation error")
+                    stack.pop()
+                    starts.pop()
+                args.append(pop_value())
+            argc = len(args)
+            if args:
+                start = args[-1]
+            if token.type == 'IF':
+                if argc != 3:
+                    raise ArithmeticError("if() takes 3 arguments")
+                # later jump first, so index of earlier one stays valid
+                start_2, start_1 = args[:2]
+                insert_jump(start_2, JUMP, len(opcodes) - start_2)
+                insert_jump(start_1, JUMP_IF_FALSE, start_2 - start_1 + 1)
+                stack.append(None)
+                starts.append(start)
+                depth -= 2
+                continue
+            opcode, operand = CALL, token.value
+        elif token.type in ('AND', 'OR'):
+            start_2 = pop_value()
+            start = pop_value()
+            insert_jump(start_2, JUMP_IF_FALSE_OR_POP if token.type == 'AND'
+                        else JUMP_IF_TRUE_OR_POP, len(opcodes) - start_2)
+            stack.append(None)
+            starts.append(start)
+            depth -= 1
+            continue
+        elif token.type in ('FUNC', 'CONST'):
+            raise ValueError("Queue is not bound to namespace")
+        else:
+            pop_value()
+            start = pop_value()
+            opcode, operand, argc = BINARY, token.operator, 2
+        stack.append(None)
+        starts.append(start)
+        depth += 1 - argc
+        stack_size = max(stack_size, depth)
+        opcodes.append(opcode)
+        operands.append(operand)
+        argcounts.append(argc)
+    if not queue:
+        raise ArithmeticError("Empty EXPRESSION")
+    if len(stack) != 1 or stack[0] is not None:
+        raise ArithmeticError("Calculation error")
+    return Program(opcodes, operands, argcounts, stack_size)
+
+
+def _unary(stack, operator, argc):
+    """Apply unary operator to top of stack."""
+    stack[-1] = operator(stack[-1])
+
+
+def _call(stack, function, argc):
+    """Call function with argc top values of stack."""
+    if argc:
+        args = stack[-argc:]
+        del stack[-argc:]
+        stack.append(function(*args))
+    else:
+        stack.append(function())
+
+
+def _jump(stack, code, opcode, offset):
+    """
+    Run jump instruction: skip offset next instructions of code iterator,
+    if jump is taken. JUMP_IF_FALSE pops condition, *_OR_POP jumps keep
+    it on stack as value of expression when jump is taken.
+    """
+    if opcode == JUMP_IF_FALSE:
+        if stack.pop():
+            return
+    elif opcode != JUMP:
+        if bool(stack[-1]) != (opcode == JUMP_IF_TRUE_OR_POP):
+            stack.pop()
+            return
+    next(islice(code, offset, offset), None)
+
+
+# Handlers of opcodes, PUSH, LOAD, BINARY, STORE and RECALL
+# are inlined in run(), jumps are run by _jump()
+_DISPATCH = (None, None, _unary, None, _call, None, None)
+
+
+def run(program, variables, dispatch=_DISPATCH):
+    """
+    Calculate program.
+    :param program: Program from assemble()
+    :param variables: values of variables for LOAD instructions
+    :type variables: dict
+    :param dispatch: handlers of UNARY and CALL opcodes
+    :return: Result of calculation
+    """
+    stack = []
+    push, pop = stack.append, stack.pop
+    registers = [None] * program.registers
+    code = iter(program.code)
+    try:
+        for opcode, operand, argc in code:
+            if opcode == PUSH:
+                push(operand)
+            elif opcode == BINARY:
+                operand_2 = pop()
+                stack[-1] = operand(stack[-1], operand_2)
+            elif opcode == LOAD:
+                try:
+                    push(variables[operand])
+                except KeyError:
+                    raise ArithmeticError("Unbound variable:" + operand)
+            elif opcode == RECALL:
+                push(registers[operand])
+            elif opcode == STORE:
+                registers[operand] = stack[-1]
+            elif opcode < JUMP:
+                dispatch[opcode](stack, operand, argc)
+            else:
+                _jump(stack, code, opcode, operand)
+    except ZeroDivisionError:
+        raise ArithmeticError("Division by zero")
+    return stack[0]
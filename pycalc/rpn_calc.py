@@ -4,40 +4,71 @@ using customized shunting-yard and reverse polish notation algorithms.
 """
 import operator
 import re
+import threading
+import time
+import weakref
 
 from collections import namedtuple, OrderedDict, deque
 
-from pycalc.ext_modules import find_attr, import_modules
+from pycalc.budget import check_tokens, run_limited
+from pycalc.ext_modules import find_attr, is_pure, Namespace
+from pycalc.instrument import _recorders, instrumented_run, stage_timer
+from pycalc.program import assemble, run, _DISPATCH
 
 
-# Constant ordered dictionary with tokens: regexp, operator and precedence
-_tkn = namedtuple('_tkn', 're, operator, precedence')
+def _if(condition, value_1, value_2):
+    """
+    Eager if() of _rpn_calc(), compiled expressions calculate
+    only the chosen value, see program.assemble().
+    """
+    return value_1 if condition else value_2
+
+
+def _and(operand_1, operand_2):
+    """Eager 'and' of _rpn_calc()."""
+    return operand_1 and operand_2
+
+
+def _or(operand_1, operand_2):
+    """Eager 'or' of _rpn_calc()."""
+    return operand_1 or operand_2
+
+
+# Constant ordered dictionary with tokens: regexp pattern, operator and
+# precedence
+_tkn = namedtuple('_tkn', 'pattern, operator, precedence')
 _TOKENS = OrderedDict([
-    ('FLOAT', _tkn(re.compile(r'\d*\.\d+'), float, 9)),
-    ('COMPLEX', _tkn(re.compile(r'\d+[jJ](?![\w\d])'), complex, 9)),
-    ('INTEGER', _tkn(re.compile(r'\d+'), int, 9)),
-    ('LPARENT', _tkn(re.compile(r'\('), str, 0)),
-    ('RPARENT', _tkn(re.compile(r'\)'), str, 0)),
-    ('PLUS', _tkn(re.compile(r'\+'), operator.add, 4)),
-    ('MINUS', _tkn(re.compile(r'-'), operator.sub, 4)),
-    ('POWER', _tkn(re.compile(r'(\^)|(\*\*)'), operator.pow, 7)),
-    ('TIMES', _tkn(re.compile(r'\*'), operator.mul, 5)),
-    ('FDIVIDE', _tkn(re.compile(r'//'), operator.floordiv, 5)),
-    ('DIVIDE', _tkn(re.compile(r'/'), operator.truediv, 5)),
-    ('COMMA', _tkn(re.compile(r','), str, 8)),
-    ('MODULO', _tkn(re.compile(r'%'), operator.mod, 5)),
-    ('EQUALS', _tkn(re.compile(r'=='), operator.eq, 2)),
-    ('LE', _tkn(re.compile(r'<='), operator.le, 3)),
-    ('LT', _tkn(re.compile(r'<'), operator.lt, 3)),
-    ('GE', _tkn(re.compile(r'>='), operator.ge, 3)),
-    ('GT', _tkn(re.compile(r'>'), operator.gt, 3)),
-    ('NE', _tkn(re.compile(r'!='), operator.ne, 2)),
-    ('SPACE', _tkn(re.compile(r'\s+'), None, None)),
-    ('FUNC', _tkn(re.compile(r'[\w]+\('), find_attr, 1)),
-    ('CONST', _tkn(re.compile(r'[\w]+'), find_attr, 9)),
-    ('ARGS', _tkn(None, bool, 1)),
-    ('UMINUS', _tkn(None, lambda x: x * -1, 6)),
-    ('UPLUS', _tkn(None, lambda x: x, 6)),
+    ('FLOAT', _tkn(r'\d*\.\d+', float, 11)),
+    ('COMPLEX', _tkn(r'\d+[jJ](?![\w\d])', complex, 11)),
+    ('INTEGER', _tkn(r'\d+', int, 11)),
+    ('LPARENT', _tkn(r'\(', str, 0)),
+    ('RPARENT', _tkn(r'\)', str, 0)),
+    ('PLUS', _tkn(r'\+', operator.add, 6)),
+    ('MINUS', _tkn(r'-', operator.sub, 6)),
+    ('POWER', _tkn(r'(\^)|(\*\*)', operator.pow, 9)),
+    ('TIMES', _tkn(r'\*', operator.mul, 7)),
+    ('FDIVIDE', _tkn(r'//', operator.floordiv, 7)),
+    ('DIVIDE', _tkn(r'/', operator.truediv, 7)),
+    ('COMMA', _tkn(r',', str, 10)),
+    ('MODULO', _tkn(r'%', operator.mod, 7)),
+    ('EQUALS', _tkn(r'==', operator.eq, 4)),
+    ('LE', _tkn(r'<=', operator.le, 5)),
+    ('LT', _tkn(r'<', operator.lt, 5)),
+    ('GE', _tkn(r'>=', operator.ge, 5)),
+    ('GT', _tkn(r'>', operator.gt, 5)),
+    ('NE', _tkn(r'!=', operator.ne, 4)),
+    ('SPACE', _tkn(r'\s+', None, None)),
+    ('IF', _tkn(r'if\(', lambda x: _if, 1)),
+    ('AND', _tkn(r'and\b', _and, 3)),
+    ('OR', _tkn(r'or\b', _or, 2)),
+    ('FUNC', _tkn(r'[\w]+\(', find_attr, 1)),
+    ('CONST', _tkn(r'[\w]+', find_attr, 11)),
+    ('VAR', _tkn(None, None, 11)),
+    ('VALUE', _tkn(None, lambda x: x, 11)),
+    ('CALL', _tkn(None, lambda x: x, 1)),
+    ('ARGS', _tkn(None, int, 1)),
+    ('UMINUS', _tkn(None, lambda x: x * -1, 8)),
+    ('UPLUS', _tkn(None, lambda x: x, 8)),
 ])
 
 
@@ -55,26 +86,129 @@ class _Token(namedtuple('token', 'index, type, value')):
         return _TOKENS[self.type].operator
 
 
+# All regexps from _TOKENS joined in one pattern with named groups.
+# Alternatives are tried in order of _TOKENS, so the name of matched
+# group is the type of token. It is compiled on first use, see _lexer().
+_TOKENS_RE = None
+
+
+def _lexer():
+    """
+    Return compiled pattern of all tokens, compile it on first call,
+    so import of module and calculation without parsing don't pay for it.
+    """
+    global _TOKENS_RE
+    if _TOKENS_RE is None:
+        _TOKENS_RE = re.compile('|'.join(
+            '(?P<{}>{})'.format(_type, pattern)
+            for (_type, (pattern, _, _)) in _TOKENS.items()
+            if pattern is not None))
+    return _TOKENS_RE
+
+
+# Tokens after which MINUS and PLUS are binary operators
+_OPERAND_END = frozenset(('FLOAT', 'INTEGER', 'CONST', 'COMPLEX', 'RPARENT'))
+# Tokens of operands
+_OPERANDS = frozenset(('FLOAT', 'INTEGER', 'CONST', 'COMPLEX'))
+# Tokens, that open parentheses, comma is allowed only right in FUNC or IF
+_CALL_OPEN = frozenset(('FUNC', 'IF', 'LPARENT'))
+# Characters after token, that can make it longer: INTEGER 1 is FLOAT 1.5
+_LOOKAHEAD = 2
+
+
+def _iter_tokens(source):
+    """
+    Generate tokens of expression like _tokenize_expr(). Expression is
+    string or iterable of its chunks, like text file, so the whole
+    expression is never held in memory: token, that ends less than
+    _LOOKAHEAD characters before the end of chunk, is matched again
+    with the next chunk.
+    :param source: expression or iterable of chunks of expression
+    :return: generator of _Token namedtuples(index, type, value)
+    """
+    t_match = _lexer().match
+    pos, count = 0, 0
+    # string is one chunk, that is ready
+    more = not isinstance(source, str)
+    buffer, chunks = ('', iter(source)) if more else (source, None)
+    while True:
+        token = t_match(buffer, pos)
+        if more and (token is None or
+                     token.end() + _LOOKAHEAD > len(buffer)):
+            chunk = next(chunks, None)
+            if chunk is None:
+                more = False
+            else:
+                buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        if pos == len(buffer):
+            return
+        if token is None:
+            raise ArithmeticError("EXPRESSION Tokenize Error")
+        if token.lastgroup != 'SPACE':
+            yield _Token(count, token.lastgroup, token.group())
+            count += 1
+        pos = token.end()
+
+
 def _tokenize_expr(expr):
     """
-    Walk through regexps in _TOKENS dict and cut expression in tokens
+    Scan expression with _lexer() pattern from position of previous match
+    and cut expression in tokens
     :param expr:
     :type expr:str
     :return: list of _Token namedtuples(index, type, value)
     """
-    token_expr = deque()
-    while expr:
-        for (_type, (_re, _, _)) in _TOKENS.items():
-            if _re is not None:
-                t_match = _re.match(expr)
-                if t_match:
-                    if _type != 'SPACE':
-                        token_expr.append((_type, t_match.group()))
-                    expr = expr[t_match.end():]
-                    break
+    return list(_iter_tokens(expr))
+
+
+def _iter_unary(tokens):
+    """
+    Generate tokens with MINUS and PLUS changed to UMINUS or UPLUS
+    according to previous token.
+    """
+    last_type = None
+    for token in tokens:
+        if token.type in {'MINUS', 'PLUS'} and \
+                last_type not in _OPERAND_END:
+            # Place U before token.type
+            token = _Token(token.index, 'U' + token.type, token.value)
+        last_type = token.type
+        yield token
+
+
+def _iter_checked(tokens):
+    """
+    Generate tokens and raise ArithmeticError, where operator, comma or )
+    comes instead of operand or vice versa, or parentheses are left open.
+    Streamed expression is not held in memory to be parsed again, so its
+    malformed tokens must not take operands of their neighbours.
+    """
+    # operand is expected, like at the start of expression
+    operand = True
+    depth, last_type = 0, None
+    for token in tokens:
+        _type = token.type
+        if _type in _OPERANDS:
+            valid, operand = operand, False
+        elif _type in _CALL_OPEN:
+            valid = operand
+            depth += 1
+        elif _type in {'UMINUS', 'UPLUS'}:
+            valid = operand
+        elif _type == 'RPARENT':
+            # function without arguments, like f()
+            valid = not operand or last_type == 'FUNC'
+            operand = False
+            depth -= 1
         else:
-            raise ArithmeticError("EXPRESSION Tokenize Error")
-    return [_Token(i, t, v) for i, (t, v) in enumerate(token_expr)]
+            valid, operand = not operand, True
+        if not valid:
+            raise ArithmeticError("Calculation error")
+        last_type = _type
+        yield token
+    if depth > 0 or operand and last_type is not None:
+        raise ArithmeticError("Calculation error")
 
 
 def _unary_replace(token_expr):
@@ -82,56 +216,54 @@ def _unary_replace(token_expr):
     Search to MINUS or PLUS and change them to UMINUS or UPLUS
     according to previous token.
     """
-    for token in token_expr:
-        not_unary_after = {'FLOAT', 'INTEGER', 'CONST', 'COMPLEX', 'RPARENT'}
-        if (token.type in {'MINUS', 'PLUS'} and
-                (token.index == 0 or
-                 token_expr[token.index - 1].type not in not_unary_after)):
-            # Place U before token.type
-            token_expr[token.index] = _Token(token.index, 'U' + token.type,
-                                             token.value)
+    token_expr[:] = _iter_unary(token_expr)
 
 
-def _postfix_queue(token_expr):
+def _iter_postfix(tokens):
     """
-    Form postfix queue from tokenized expression using shunting-yard algorithm.
+    Generate postfix queue from tokens using shunting-yard algorithm.
 
-    If expression have function, then presence of arguments for that function
-    added before function token.
-    If function have few arguments then RPN algorithm will pop them from stack
-    until comma will be top token on stack
+    If expression have function, then ARGS token with number of arguments
+    of that function added before function token.
+    RPN algorithm pops that number of arguments from stack with commas
+    between them, so nested function can't take arguments of outer one.
+    Function has no arguments if next token is RPARENT, so one token
+    of lookahead is enough and memory is bounded by depth of stack.
 
-    :return: queue of tokens ready for reverse polish calculation
+    :return: generator of tokens ready for reverse polish calculation
     """
     stack = deque()
-    queue = deque()
     have_args = deque()
-    for token in token_expr:
+    # previous token is FUNC, which arguments are known by next token
+    func = False
+    for token in tokens:
+        if func:
+            have_args.append(0 if token.type == 'RPARENT' else 1)
+            func = False
         if token.type in {'FLOAT', 'INTEGER', 'CONST', 'COMPLEX'}:
-            queue.append(token)
-        elif token.type == 'FUNC':
+            yield token
+        elif token.type in {'FUNC', 'IF'}:
             stack.append(token)
-            # If function have no arguments we append False before FUNC
-            if token_expr[token.index + 1].type == 'RPARENT':
-                have_args.append(False)
-            else:
-                have_args.append(True)
+            func = True
+        elif token.type == 'COMMA':
+            while stack and stack[-1].type not in _CALL_OPEN:
+                yield stack.pop()
+            if not stack or stack[-1].type == 'LPARENT':
+                raise ArithmeticError("Comma outside of function call")
+            have_args[-1] += 1
+            yield token
         elif not stack:
             stack.append(token)
-        elif token.type == 'COMMA':
-            while stack[-1].type != 'FUNC':
-                queue.append(stack.pop())
-            queue.append(token)
         elif token.type == 'LPARENT':
             stack.append(token)
         elif token.type == 'RPARENT':
-            while stack[-1].type not in {'LPARENT', 'FUNC'}:
-                queue.append(stack.pop())
+            while stack[-1].type not in {'LPARENT', 'FUNC', 'IF'}:
+                yield stack.pop()
                 if not stack:
                     raise ArithmeticError("Parentheses error")
-            if stack[-1].type == 'FUNC':
-                queue.append(_Token('', 'ARGS', have_args.pop()))
-                queue.append(stack.pop())
+            if stack[-1].type in {'FUNC', 'IF'}:
+                yield _Token('', 'ARGS', have_args.pop())
+                yield stack.pop()
             else:
                 stack.pop()
         elif token.type in {'UMINUS', 'UPLUS'} and stack[-1].type == 'POWER':
@@ -146,59 +278,110 @@ def _postfix_queue(token_expr):
         elif token.precedence <= stack[-1].precedence:
             while stack:
                 if token.precedence <= stack[-1].precedence:
-                    queue.append(stack.pop())
+                    yield stack.pop()
                     continue
                 else:
                     break
             stack.append(token)
         else:
             stack.append(token)
+    if func:
+        raise ArithmeticError("Parentheses error")
     while stack:
-        queue.append(stack.pop())
-    return queue
+        yield stack.pop()
+
+
+def _postfix_queue(token_expr):
+    """
+    Form postfix queue from tokenized expression, see _iter_postfix().
+    :return: queue of tokens ready for reverse polish calculation
+    """
+    return deque(_iter_postfix(token_expr))
 
 
-def _rpn_calc(queue):
+def _rpn_calc(queue, variables=None, namespace=None):
     """
     Calculate expression using postfix evaluation algorithm.
-    :param queue:
+    :param queue: postfix queue or generator of its tokens
+    :param variables: values for VAR tokens of compiled expressions
+    :type variables: dict
+    :param namespace: Namespace for CONST and FUNC tokens,
+                      find_attr() is used if namespace is None
     :return:
     """
+    find = find_attr if namespace is None else namespace.find
     rpn_stack = deque()
-    if queue:
-        for element in queue:
-            if element.type in ('FLOAT', 'INTEGER', 'COMPLEX',
-                                'CONST', 'COMMA', 'ARGS'):
-                rpn_stack.append(element.operator(element.value))
-            elif element.type == 'FUNC':
-                fargs = deque()
-                if rpn_stack.pop() is True:
-                    fargs.append(rpn_stack.pop())
-                while rpn_stack and rpn_stack[-1] == ',':
-                    rpn_stack.pop()
-                    fargs.append(rpn_stack.pop())
-                fargs.reverse()
-                rpn_stack.append(element.operator(element.value[:-1])(*fargs))
-            elif element.type in {'UMINUS', 'UPLUS'}:
-                try:
-                    operand = rpn_stack.pop()
-                    rpn_stack.append(element.operator(operand))
-                except IndexError:
-                    raise ArithmeticError("Calculation error")
-            else:
-                try:
-                    operand_2, operand_1 = rpn_stack.pop(), rpn_stack.pop()
-                    rpn_stack.append(element.operator(operand_1, operand_2))
-                except ZeroDivisionError:
-                    raise ArithmeticError("Division by zero")
-                except IndexError:
-                    raise ArithmeticError("Calculation error")
-        result = rpn_stack.pop()
-        if rpn_stack:
-            raise ArithmeticError("Calculation error")
-        return result
-    else:
+    for element in queue:
+        if element.type in ('FLOAT', 'INTEGER', 'COMPLEX',
+                            'COMMA', 'ARGS', 'VALUE'):
+            rpn_stack.append(element.operator(element.value))
+        elif element.type == 'CONST':
+            rpn_stack.append(find(element.value))
+        elif element.type == 'VAR':
+            try:
+                rpn_stack.append(variables[element.value])
+            except (KeyError, TypeError):
+                raise ArithmeticError("Unbound variable:" +
+                                      element.value)
+        elif element.type in ('FUNC', 'CALL', 'IF'):
+            fargs = deque()
+            try:
+                for number in range(rpn_stack.pop()):
+                    if number and rpn_stack.pop() != ',':
+                        raise ArithmeticError("Calculation error")
+                    fargs.appendleft(rpn_stack.pop())
+            except (IndexError, TypeError):
+                # no ARGS marker or too few arguments
+                raise ArithmeticError("Calculation error")
+            function = (element.operator(element.value)
+                        if element.type in ('CALL', 'IF')
+                        else find(element.value[:-1]))
+            rpn_stack.append(function(*fargs))
+        elif element.type in {'UMINUS', 'UPLUS'}:
+            try:
+                operand = rpn_stack.pop()
+                rpn_stack.append(element.operator(operand))
+            except IndexError:
+                raise ArithmeticError("Calculation error")
+        else:
+            try:
+                operand_2, operand_1 = rpn_stack.pop(), rpn_stack.pop()
+                rpn_stack.append(element.operator(operand_1, operand_2))
+            except ZeroDivisionError:
+                raise ArithmeticError("Division by zero")
+            except IndexError:
+                raise ArithmeticError("Calculation error")
+    if not rpn_stack:
         raise ArithmeticError("Empty EXPRESSION")
+    result = rpn_stack.pop()
+    if rpn_stack:
+        raise ArithmeticError("Calculation error")
+    return result
+
+
+# Characters before integer, that make integer( implicit multiplication
+_IMPLICIT_AFTER = frozenset(' +-*/^%><=,(')
+# Types of tokens, that can be implicitly multiplied by previous token
+_IMPLICIT_TYPES = frozenset(('LPARENT', 'CONST', 'FUNC', 'IF'))
+
+
+def _implicit_times(expr, last_type, last_start, _type, value):
+    """
+    Is TIMES implied between adjacent tokens of expr: in 2(, )( and
+    between number and name, like 2pi, unless name starts with e, that is
+    taken for broken exponent. 2( is multiplication only at the start of
+    expr or after operator, comma, ( or space, not in (1)2(3).
+    :param expr: expression
+    :param last_type: type of previous token
+    :param last_start: index of previous token in expr
+    :param _type: type of token, one of _IMPLICIT_TYPES
+    :param value: value of token
+    :return: bool
+    """
+    if _type == 'LPARENT':
+        return last_type == 'RPARENT' or last_type == 'INTEGER' and (
+            last_start == 0 or expr[last_start - 1] in _IMPLICIT_AFTER)
+    return last_type in {'INTEGER', 'FLOAT'} and value[0] not in 'eE'
 
 
 def _modify_expr(expr):
@@ -210,13 +393,584 @@ def _modify_expr(expr):
     """
     # filter unsupported characters
     expr = re.sub(r'[^\w +\-*/^%><=,.!()]', '', expr)
-    # ...2(...) changes to ...2*(...)
-    expr = re.sub(r'([ +\-*/^%><=,(][\d]+)\(', r'\g<1>*(', expr)
-    # 2(...) changes to 2*(...)
-    expr = re.sub(r'(^[\d]+)\(', r'\g<1>*(', expr)
     # (a,b, ) to (a,b)
     expr = re.sub(r',\s*\)', r')', expr)
-    return expr
+    # 2(...), (...)(...) and 2pi change to 2*(...), (...)*(...) and 2*pi
+    t_match = _lexer().match
+    parts = []
+    pos = done = 0
+    last_type = last_start = last_end = None
+    while pos < len(expr):
+        match = t_match(expr, pos)
+        if match is None:
+            # error is raised by _tokenize_expr()
+            break
+        start, pos = match.span()
+        _type = match.lastgroup
+        if _type == 'SPACE':
+            continue
+        if (last_end == start and _type in _IMPLICIT_TYPES and
+                _implicit_times(expr, last_type, last_start, _type,
+                                match.group())):
+            parts.append(expr[done:start])
+            parts.append('*')
+            done = start
+        last_type, last_start, last_end = _type, start, pos
+    parts.append(expr[done:])
+    return ''.join(parts)
+
+
+def _parse(expr, vprint, budget=None):
+    """
+    Run all parsing stages and return postfix queue of expression.
+    :param expr: EXPRESSION for calculation
+    :param vprint: function for printing verbose information
+    :param budget: Budget with limit of number of tokens
+    :return: queue of tokens ready for reverse polish calculation
+    """
+    timer = stage_timer()
+    expr = _modify_expr(expr)
+    timer.lap('modify')
+    vprint("EXPR:\t", expr)
+    _token_expr = _tokenize_expr(expr)
+    timer.lap('tokenize')
+    timer.tokens(len(_token_expr))
+    if budget is not None:
+        check_tokens(len(_token_expr), budget)
+    _unary_replace(_token_expr)
+    timer.lap('unary')
+    vprint('TOKENS:\t', '  '.join(str(v) + ':' + t for i, t, v in _token_expr))
+    _queue = _postfix_queue(_token_expr)
+    timer.lap('postfix')
+    vprint('RPN:\t', '  '.join(str(v) + ':' + t for i, t, v in _queue))
+    return _queue
+
+
+# Precedences of token types for _scan()
+_PRECEDENCE = {_type: token.precedence for _type, token in _TOKENS.items()}
+
+
+def _scan(expr, budget=None):
+    """
+    Parse expression in one pass: every token matched by _lexer() pattern
+    goes straight to shunting-yard stack or queue, like in _postfix_queue().
+
+    Rewrites of _modify_expr() and _unary_replace() are made on the fly:
+    TIMES is inserted by _implicit_times(); comma before ) is dropped;
+    MINUS and PLUS become unary by previous token. Expression with
+    characters, that _modify_expr() filters out, is parsed by _parse().
+    :param expr: EXPRESSION for calculation
+    :param budget: Budget with limit of number of tokens
+    :return: queue of tokens ready for reverse polish calculation
+    """
+    timer = stage_timer()
+    t_match = _lexer().match
+    stack, queue, have_args = deque(), deque(), deque()
+    pos, end, count = 0, len(expr), 0
+    last_type = last_start = last_end = None
+    # previous token is FUNC, which arguments are known by next token
+    func = False
+    while pos < end:
+        match = t_match(expr, pos)
+        if match is None:
+            return _parse(expr, lambda *args, **kwargs: None, budget)
+        start, pos = match.span()
+        _type = match.lastgroup
+        if _type == 'SPACE':
+            if match.group().strip(' '):
+                # other whitespace is filtered out by _modify_expr()
+                return _parse(expr, lambda *args, **kwargs: None, budget)
+            continue
+        if _type == 'COMMA':
+            # (a,b, ) to (a,b)
+            after = pos
+            while after < end and expr[after] == ' ':
+                after += 1
+            if after < end and expr[after] == ')':
+                continue
+        elif _type in {'MINUS', 'PLUS'} and last_type not in _OPERAND_END:
+            _type = 'U' + _type
+        token = _Token(count, _type, match.group())
+        if (last_end == start and _type in _IMPLICIT_TYPES and
+                _implicit_times(expr, last_type, last_start, _type,
+                                token.value)):
+            tokens = (_Token(count, 'TIMES', '*'),
+                      _Token(count + 1, _type, token.value))
+        else:
+            tokens = (token,)
+        count += len(tokens)
+        last_type, last_start, last_end = _type, start, pos
+        for token in tokens:
+            _type = token.type
+            if func:
+                have_args.append(0 if _type == 'RPARENT' else 1)
+                func = False
+            if _type in {'FLOAT', 'INTEGER', 'CONST', 'COMPLEX'}:
+                queue.append(token)
+            elif _type in {'FUNC', 'IF'}:
+                stack.append(token)
+                func = True
+            elif _type == 'COMMA':
+                while stack and stack[-1].type not in _CALL_OPEN:
+                    queue.append(stack.pop())
+                if not stack or stack[-1].type == 'LPARENT':
+                    # _parse() raises error, unless comma is dropped
+                    # after characters are filtered out, like in (1,\t)
+                    return _parse(expr, lambda *args, **kwargs: None,
+                                  budget)
+                have_args[-1] += 1
+                queue.append(token)
+            elif not stack:
+                stack.append(token)
+            elif _type == 'LPARENT':
+                stack.append(token)
+            elif _type == 'RPARENT':
+                while stack[-1].type not in {'LPARENT', 'FUNC', 'IF'}:
+                    queue.append(stack.pop())
+                    if not stack:
+                        raise ArithmeticError("Parentheses error")
+                if stack[-1].type in {'FUNC', 'IF'}:
+                    queue.append(_Token('', 'ARGS', have_args.pop()))
+                    queue.append(stack.pop())
+                else:
+                    stack.pop()
+            elif _type in {'UMINUS', 'UPLUS'} and stack[-1].type == 'POWER':
+                stack.append(token)
+            else:
+                precedence = _PRECEDENCE[_type]
+                top = _PRECEDENCE[stack[-1].type]
+                if precedence == top and \
+                        _type in {'POWER', 'UMINUS', 'UPLUS'}:
+                    stack.append(token)
+                    continue
+                while stack and precedence <= _PRECEDENCE[stack[-1].type]:
+                    queue.append(stack.pop())
+                stack.append(token)
+    if func:
+        raise ArithmeticError("Parentheses error")
+    while stack:
+        queue.append(stack.pop())
+    timer.lap('scan')
+    timer.tokens(count)
+    if budget is not None:
+        check_tokens(count, budget)
+    return queue
+
+
+# Token types of fingerprint with their values, operators are known
+# by type, like POWER of ^ and **
+_NUMBERS = frozenset(('FLOAT', 'INTEGER', 'COMPLEX'))
+_NAMED = frozenset(('CONST', 'FUNC', 'ARGS'))
+
+
+def _fingerprint(queue):
+    """
+    Fingerprint of postfix queue, see fingerprint().
+    """
+    return tuple(
+        (token.type, token.operator(token.value) if token.type in _NUMBERS
+         else token.value if token.type in _NAMED else None)
+        for token in queue)
+
+
+def fingerprint(expr):
+    """
+    Canonical hashable fingerprint of expression: pairs of type and value
+    of tokens of its postfix queue. Expressions, that differ only in
+    whitespace, ^ and **, implicit multiplication, redundant parentheses,
+    trailing commas or spelling of numbers, like 2(x) and 2 * x, have
+    the same fingerprint and the same value.
+    :param expr: EXPRESSION for calculation
+    :return: tuple of pairs (type, value)
+    """
+    return _fingerprint(_scan(expr))
+
+
+_CacheInfo = namedtuple('_CacheInfo',
+                        'hits, misses, evictions, maxsize, currsize, ttl')
+
+
+class _LRUCache:
+    """
+    Thread-safe bounded cache with least-recently-used eviction and
+    optional time to live of entries. Expired entries are counted as
+    evictions.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = timer
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """
+        Return cached value and mark it as recently used.
+        :return: value or None if key is missing or expired
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > self._timer():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Add value to cache, evicting least recently used entries.
+        """
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            expires = None if self.ttl is None else self._timer() + self.ttl
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            self._shrink()
+
+    def _shrink(self):
+        while self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def configure(self, maxsize, ttl):
+        """
+        Change max size and time to live of entries.
+        """
+        with self._lock:
+            self.maxsize, self.ttl = maxsize, ttl
+            self._shrink()
+
+    def clear(self):
+        """
+        Remove all entries and reset counters.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """
+        :return: _CacheInfo namedtuple with counters and sizes
+        """
+        with self._lock:
+            return _CacheInfo(self.hits, self.misses, self.evictions,
+                              self.maxsize, len(self._data), self.ttl)
+
+
+# Cache of compiled expressions:
+# (raw expr, tuple(modules), optimize, backend) -> CompiledExpression
+_parse_cache = _LRUCache()
+
+
+def cache_info():
+    """
+    Statistics of parse cache used by calc() and compile().
+    :return: _CacheInfo(hits, misses, evictions, maxsize, currsize, ttl)
+    """
+    return _parse_cache.info()
+
+
+def cache_clear():
+    """
+    Remove all parsed expressions from cache and reset its counters.
+    """
+    _parse_cache.clear()
+
+
+def cache_configure(maxsize=1024, ttl=None):
+    """
+    Configure parse cache.
+    :param maxsize: max number of cached expressions,
+                    None for unbounded cache, 0 for disabled cache
+    :param ttl: time to live of cached expression in seconds or None
+    """
+    _parse_cache.configure(maxsize, ttl)
+
+
+# Backends of compiled expressions, see CompiledExpression
+BACKENDS = ('stack', 'closure')
+
+
+class CompiledExpression:
+    """
+    Parsed expression that can be evaluated many times.
+
+    Holds postfix queue of expression with functions and constants
+    bound to their objects in namespace, and Program assembled from it,
+    so evaluation skips all parsing stages and name lookups.
+    Constants that can't be found in namespace become variables,
+    which values are passed to evaluate() on every call.
+    Optional optimizer folds constant subtrees of queue,
+    removed_nodes is the number of tokens it removed, and calculates
+    common subexpressions of program only once.
+    Program is calculated by stack interpreter or, with 'closure'
+    backend, by tree of closures built from it, see closures.build().
+    specialize() makes new compiled expression with values of some
+    variables fixed. Expression is pure if it calls pure functions only,
+    so it gives the same value for the same variables.
+    """
+
+    def __init__(self, expr, namespace, queue, optimize=False,
+                 backend='stack'):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend:" + str(backend))
+        self.expr = expr
+        self.backend = backend
+        self.modules = namespace.modules
+        variables = OrderedDict()
+        self._queue = deque()
+        for token in queue:
+            if token.type == 'CONST':
+                try:
+                    token = _Token(token.index, 'VALUE',
+                                   namespace.find(token.value))
+                except ArithmeticError:
+                    variables[token.value] = None
+                    token = _Token(token.index, 'VAR', token.value)
+            elif token.type == 'FUNC':
+                token = _Token(token.index, 'CALL',
+                               namespace.find(token.value[:-1]))
+            elif token.type == 'VAR':
+                # queue is already bound, see specialize()
+                variables[token.value] = None
+            self._queue.append(token)
+        self.variables = tuple(variables)
+        self.pure = all(is_pure(token.value) for token in self._queue
+                        if token.type == 'CALL')
+        self._namespace = namespace
+        self.removed_nodes = 0
+        if optimize:
+            from pycalc.optimizer import optimize
+            self._queue, self.removed_nodes = optimize(self._queue)
+        self.program = assemble(self._queue)
+        if optimize:
+            from pycalc.optimizer import eliminate_common
+            self.program = eliminate_common(self.program)
+        self._closure = None
+        if backend == 'closure':
+            from pycalc.closures import build
+            self._closure = build(self.program)
+
+    def __repr__(self):
+        return '<CompiledExpression {!r} variables={!r}>'.format(
+            self.expr, self.variables)
+
+    def evaluate(self, **bindings):
+        """
+        Calculate compiled expression with given values of variables.
+        :param bindings: values of variables, extra names are ignored
+        :return: Result of calculation
+        """
+        return self.run(bindings)
+
+    def specialize(self, **bindings):
+        """
+        Partially evaluate compiled expression on values of some
+        variables, see optimizer.specialize().
+        :param bindings: values of variables, extra names are ignored
+        :return: optimized CompiledExpression of the rest of variables,
+                 its removed_nodes is the number of tokens removed from
+                 this expression
+        """
+        from pycalc.optimizer import specialize
+        queue, removed = specialize(self._queue, bindings)
+        compiled = CompiledExpression(self.expr, self._namespace, queue,
+                                      True, self.backend)
+        compiled.removed_nodes = removed
+        return compiled
+
+    def run(self, variables, budget=None, memo=None):
+        """
+        Calculate compiled expression within budget.
+        :param variables: values of variables, extra names are ignored
+        :type variables: dict
+        :param budget: Budget of evaluation, no limits if None
+        :param memo: Memo with cached results of pure functions
+        :return: Result of calculation
+        :raise BudgetExceeded: if evaluation exceeds budget
+
+        Evaluation with budget, memo or recorders runs on stack
+        interpreter for any backend.
+        """
+        dispatch = _DISPATCH if memo is None else memo.dispatch
+        if _recorders:
+            return instrumented_run(self.program, variables, budget,
+                                    dispatch)
+        if budget is not None:
+            return run_limited(self.program, variables, budget, dispatch)
+        if self._closure is not None and memo is None:
+            return self._closure(variables)
+        return run(self.program, variables, dispatch)
+
+
+class Calculator:
+    """
+    Calculator with its own resolved namespace of modules,
+    cache of compiled expressions and options.
+
+    Calculator has no shared mutable state besides the cache, which is
+    thread-safe, so many calculators with different module sets
+    can be used from many threads.
+    """
+
+    def __init__(self, modules=(), optimize: bool = False, cache=None,
+                 budget=None, memoize: bool = False, store=None,
+                 backend='stack'):
+        """
+        :param modules: Additional modules
+        :type modules: list[str]
+        :param optimize: Fold constant subtrees of compiled expressions
+        :type optimize: bool
+        :param cache: _LRUCache for compiled expressions, new one if None
+        :param budget: Budget of parsing and evaluation, no limits if None
+        :param memoize: Cache results of pure functions, see Memo
+        :type memoize: bool
+        :param store: ExpressionStore with parsed expressions
+        :param backend: default backend of compiled expressions,
+                        one of BACKENDS
+        """
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend:" + str(backend))
+        self.modules = tuple(modules)
+        self.namespace = Namespace([*self.modules, 'math', 'builtins'])
+        self.optimize = optimize
+        self.budget = budget
+        self.store = store
+        self.backend = backend
+        self.memo = None
+        if memoize:
+            from pycalc.memo import Memo
+            self.memo = Memo()
+        self.cache = _LRUCache() if cache is None else cache
+        # fingerprint key -> compiled expression, that is alive in cache
+        self._canonical = weakref.WeakValueDictionary()
+
+    def __repr__(self):
+        return '<Calculator modules={!r}>'.format(self.modules)
+
+    def compile(self, expr: str, optimize=None, verbose: bool = False,
+                backend=None):
+        """
+        Return compiled expression from cache, compile expression
+        and put it to cache on cache miss. Postfix queue of expression
+        is loaded from store if it has expression. Equivalent
+        expressions with the same fingerprint() share compiled
+        expression, that is compiled for the first of them.
+        :param expr: EXPRESSION for calculation
+        :param optimize: Fold constant subtrees, option of calculator
+                         is used if None
+        :param verbose: Print stages of parsing, cache and store
+                        are not read
+        :param backend: backend of compiled expression, backend
+                        of calculator is used if None
+        :return: CompiledExpression object
+        """
+        optimize = self.optimize if optimize is None else optimize
+        backend = self.backend if backend is None else backend
+        key = (expr, self.modules, optimize, backend)
+        # verbose compilation prints stages, so it skips cache and store
+        compiled = None if verbose else self.cache.get(key)
+        if compiled is None:
+            queue = (None if self.store is None or verbose
+                     else self.store.get(expr))
+            if queue is None and verbose:
+                # staged parsing prints every stage
+                queue = _parse(expr, print, self.budget)
+            elif queue is None:
+                queue = _scan(expr, self.budget)
+            elif self.budget is not None:
+                check_tokens(len(queue), self.budget)
+            canonical = (_fingerprint(queue),) + key[1:]
+            compiled = self._canonical.get(canonical)
+            if compiled is None:
+                compiled = CompiledExpression(expr, self.namespace, queue,
+                                              optimize, backend)
+                self._canonical[canonical] = compiled
+            self.cache.put(key, compiled)
+        return compiled
+
+    def calc(self, expr: str, verbose: bool = False):
+        """
+        Calculate expression, see calc().
+        """
+        compiled = self.compile(expr, verbose=verbose)
+        if compiled.variables:
+            raise ArithmeticError("Unknown function or constant:" +
+                                  str(compiled.variables[0].split('.')))
+        return compiled.run(None, self.budget, self.memo)
+
+    def evaluate(self, expr: str, **bindings):
+        """
+        Calculate expression with given values of variables.
+        """
+        return self.compile(expr).run(bindings, self.budget, self.memo)
+
+    def specialize(self, expr: str, **bindings):
+        """
+        Return compiled expression specialized on values of some variables
+        from cache, like parameters of one tenant, specialize it and put
+        it to cache on cache miss, see CompiledExpression.specialize().
+        Bindings with unhashable values are specialized without cache.
+        :param expr: EXPRESSION for calculation
+        :param bindings: values of variables, extra names are ignored
+        :return: CompiledExpression of the rest of variables
+        """
+        from pycalc.memo import _arg_key
+        compiled = self.compile(expr)
+        try:
+            bound = frozenset((name, _arg_key(value))
+                              for name, value in bindings.items()
+                              if name in compiled.variables)
+            key = ('specialize', expr, self.modules, self.backend, bound)
+            specialized = self.cache.get(key)
+        except TypeError:
+            return compiled.specialize(**bindings)
+        if specialized is None:
+            specialized = compiled.specialize(**bindings)
+            self.cache.put(key, specialized)
+        return specialized
+
+    def cache_info(self):
+        """
+        :return: _CacheInfo(hits, misses, evictions, maxsize, currsize, ttl)
+        """
+        return self.cache.info()
+
+    def cache_clear(self):
+        """
+        Remove all compiled expressions from cache and reset its counters.
+        """
+        self.cache.clear()
+        self._canonical.clear()
+
+
+# Calculators of calc() and compile() for every used module set,
+# all of them share _parse_cache
+_calculators = {}
+_calculators_lock = threading.Lock()
+
+
+def _default_calculator(modules):
+    """
+    Return calculator of module set, that is created once.
+    """
+    key = tuple(modules)
+    calculator = _calculators.get(key)
+    if calculator is None:
+        with _calculators_lock:
+            calculator = _calculators.get(key)
+            if calculator is None:
+                calculator = Calculator(key, cache=_parse_cache)
+                _calculators[key] = calculator
+    return calculator
 
 
 def calc(expr: str, modules=(), verbose: bool = False):
@@ -233,18 +987,44 @@ def calc(expr: str, modules=(), verbose: bool = False):
     :type verbose: bool
     :return: Result of calculation
     """
-    # vprint will print out verbose information
-    # if verbose=True, otherwise just return None
-    vprint = print if verbose else lambda *args, **kwargs: None
-    global _modules
-    _modules = [*modules, 'math', 'builtins']
-    expr = _modify_expr(expr)
-    vprint("EXPR:\t", expr)
-    import_modules(_modules)
-    _token_expr = _tokenize_expr(expr)
-    _unary_replace(_token_expr)
-    vprint('TOKENS:\t', '  '.join(str(v) + ':' + t for i, t, v in _token_expr))
-    _queue = _postfix_queue(_token_expr)
-    vprint('RPN:\t', '  '.join(str(v) + ':' + t for i, t, v in _queue))
-    _result = _rpn_calc(_queue)
-    return _result
+    return _default_calculator(modules).calc(expr, verbose)
+
+
+def calc_stream(source, modules=()):
+    """
+    Calculate huge machine-generated expression, that is read by chunks.
+
+    Tokenizer, unary detection, shunting-yard and evaluation are chained
+    generators, so memory is bounded by depth of nesting of expression,
+    not by its length. Rewrites of _modify_expr() need the whole string
+    and are not made: implicit multiplication like 2(3) and characters,
+    that calc() filters out, are errors. if(), 'and' and 'or' calculate
+    both values, like _rpn_calc().
+
+    :param source: expression or iterable of its chunks, like text file
+    :param modules: Additional modules
+    :type modules: list[str]
+    :return: Result of calculation
+    """
+    tokens = _iter_checked(_iter_unary(_iter_tokens(source)))
+    return _rpn_calc(_iter_postfix(tokens),
+                     namespace=_default_calculator(modules).namespace)
+
+
+def compile(expr: str, modules=(), optimize: bool = False,
+            backend='stack'):
+    """
+    Parse expression once for evaluating it many times.
+
+    :param expr: EXPRESSION for calculation
+    :type expr: str
+    :param modules: Additional modules
+    :type modules: list[str]
+    :param optimize: Fold constant subtrees of expression
+    :type optimize: bool
+    :param backend: 'stack' interpreter of Program or tree of 'closure'
+    :type backend: str
+    :return: CompiledExpression object
+    """
+    return _default_calculator(modules).compile(expr, optimize,
+                                                backend=backend)
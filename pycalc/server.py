@@ -0,0 +1,356 @@
+"""
+This module provide asyncio server of expression evaluation with
+JSON-lines protocol, run it with $python3 -m pycalc serve.
+
+Every request is one line with JSON object:
+    {"id": 1, "expr": "x*2", "modules": ["cmath"], "vars": {"x": 3}}
+only "expr" is required. Response is one line with the same id and
+"result" or "error":
+    {"id": 1, "result": 6}
+Request {"id": 2, "cmd": "stats"} returns counters of server in "stats".
+
+Many requests can be sent without waiting for responses, responses
+are written as soon as they are ready, so they may come out of order.
+Expressions are calculated in worker pool, so event loop stays
+responsive. Number of requests in flight is limited per connection and
+for whole server: server stops reading new requests from connection
+until some of them are answered.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import ipaddress
+import json
+import os
+import time
+
+from pycalc.rpn_calc import Calculator
+
+# Hosts, that are allowed besides loopback addresses
+_LOCAL_HOSTS = ('localhost',)
+
+
+def _json_value(value):
+    """
+    Convert result of calculation to JSON value, complex numbers and
+    results of functions from additional modules are converted to str.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+@functools.lru_cache(maxsize=64)
+def _calculator(modules, budget):
+    """
+    Calculator of worker for module set and budget.
+    """
+    return Calculator(modules, budget=budget)
+
+
+def evaluate(expr, modules=(), variables=None, budget=None):
+    """
+    Calculate expression in worker, errors are returned instead of raised,
+    so only JSON values are sent back from worker process.
+    :param expr: EXPRESSION for calculation
+    :param modules: Additional modules
+    :param variables: values of variables
+    :param budget: Budget of evaluation
+    :return: tuple(True, result) or tuple(False, error message)
+    """
+    try:
+        calculator = _calculator(tuple(modules), budget)
+        # variables are not keyword arguments, so any name is allowed
+        result = calculator.compile(expr).run(
+            variables or None, calculator.budget, calculator.memo)
+        return True, _json_value(result)
+    except Exception as error:
+        return False, str(error) or type(error).__name__
+    except BaseException as error:
+        # exit() in expression must not stop worker or server
+        return False, type(error).__name__
+
+
+def _check_local(host):
+    """
+    Raise ValueError if host is not loopback address.
+    """
+    if host in _LOCAL_HOSTS:
+        return
+    try:
+        local = ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        local = False
+    if not local:
+        raise ValueError("Server can listen only on loopback address, "
+                         "not " + host)
+
+
+def _decode_request(line):
+    """
+    Decode request line to JSON object.
+    """
+    try:
+        request = json.loads(line.decode('utf-8'))
+    except ValueError:
+        raise ValueError("Invalid JSON")
+    if not isinstance(request, dict):
+        raise ValueError("Request must be JSON object")
+    return request
+
+
+def _check_request(request):
+    """
+    Raise ValueError if fields of request have wrong types.
+    """
+    if request.get('cmd') is not None:
+        if request['cmd'] != 'stats':
+            raise ValueError("Unknown command:" + str(request['cmd']))
+        return
+    if not isinstance(request.get('expr'), str):
+        raise ValueError("Request must have expr string")
+    modules = request.get('modules') or []
+    if (not isinstance(modules, list) or
+            not all(isinstance(module, str) for module in modules)):
+        raise ValueError("modules must be list of strings")
+    variables = request.get('vars') or {}
+    if not isinstance(variables, dict):
+        raise ValueError("vars must be JSON object")
+    # lists or strings could make huge values, like len(x*10**7)
+    if not all(isinstance(value, (int, float))
+               for value in variables.values()):
+        raise ValueError("vars must have number values")
+
+
+class Server:
+    """
+    Expression evaluation server on TCP port of loopback address
+    or on Unix socket.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, path=None, executor=None,
+                 max_pending=64, max_inflight=1024, max_line=65536,
+                 budget=None):
+        """
+        :param host: loopback address for TCP server
+        :param port: TCP port, any free port if 0
+        :param path: path of Unix socket, TCP is used if None
+        :param executor: concurrent.futures executor for calculation,
+                         ProcessPoolExecutor if None
+        :param max_pending: max requests in flight per connection
+        :param max_inflight: max requests in flight for whole server
+        :param max_line: max length of request line in bytes
+        :param budget: Budget of every calculation, no limits if None
+        """
+        if path is None:
+            _check_local(host)
+        self.host, self.port, self.path = host, port, path
+        self._executor = executor
+        self._own_executor = executor is None
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        self.max_line = max_line
+        self.budget = budget
+        self._server = None
+        self._inflight = None
+        # tasks of open connections
+        self._connections = set()
+        self._started = time.time()
+        self._counters = dict.fromkeys(
+            ('connections', 'active_connections', 'requests', 'results',
+             'errors', 'in_flight', 'max_in_flight'), 0)
+
+    @property
+    def address(self):
+        """
+        Address of listening socket: (host, port) or path of Unix socket.
+        """
+        if self.path is not None:
+            return self.path
+        return self._server.sockets[0].getsockname()[:2]
+
+    def stats(self):
+        """
+        :return: dict of server counters
+        """
+        stats = dict(self._counters)
+        stats['uptime'] = time.time() - self._started
+        return stats
+
+    async def start(self):
+        """
+        Start listening.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor()
+        # worker processes are forked before connections are accepted,
+        # forked worker would keep socket of client open
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, os.getpid)
+            for _ in range(getattr(self._executor, '_max_workers', 1))))
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._started = time.time()
+        if self.path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._accept, self.path, limit=self.max_line)
+        else:
+            self._server = await asyncio.start_server(
+                self._accept, self.host, self.port, limit=self.max_line)
+
+    async def close(self, timeout=1.0):
+        """
+        Stop listening, wait for open connections
+        and shut down own worker pool.
+        :param timeout: seconds to wait for connections, then still
+                        open connections are closed
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._connections:
+            _, open_tasks = await asyncio.wait(self._connections,
+                                               timeout=timeout)
+            # idle clients would keep connections open forever
+            for task in open_tasks:
+                task.cancel()
+            if open_tasks:
+                await asyncio.wait(open_tasks)
+        if self._own_executor:
+            self._executor.shutdown()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _respond(self, writer, response):
+        """
+        Write response line, wait while client is reading slower
+        than server is writing.
+        """
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    async def _process(self, writer, request_id, request, pending):
+        """
+        Calculate request in worker pool and write response.
+        """
+        counters = self._counters
+        try:
+            loop = asyncio.get_event_loop()
+            try:
+                ok, value = await loop.run_in_executor(
+                    self._executor, evaluate, request['expr'],
+                    tuple(request.get('modules') or ()),
+                    request.get('vars'), self.budget)
+            except Exception as error:
+                # failed worker, like BrokenProcessPool, fails request only
+                ok, value = False, ("Worker error:" +
+                                    (str(error) or type(error).__name__))
+            if ok:
+                counters['results'] += 1
+                response = {'id': request_id, 'result': value}
+            else:
+                counters['errors'] += 1
+                response = {'id': request_id, 'error': value}
+            await self._respond(writer, response)
+        except ConnectionError:
+            pass
+        finally:
+            counters['in_flight'] -= 1
+            self._inflight.release()
+            pending.release()
+
+    def _accept(self, reader, writer):
+        """
+        Start task of new connection.
+        """
+        task = asyncio.ensure_future(self._handle(reader, writer))
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+
+    async def _handle(self, reader, writer):
+        """
+        Read requests from connection and start their calculation.
+        """
+        counters = self._counters
+        counters['connections'] += 1
+        counters['active_connections'] += 1
+        pending = asyncio.Semaphore(self.max_pending)
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    counters['errors'] += 1
+                    await self._respond(writer, {
+                        'id': None, 'error': "Request line is too long"})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                counters['requests'] += 1
+                request_id = None
+                try:
+                    request = _decode_request(line)
+                    request_id = request.get('id')
+                    _check_request(request)
+                except ValueError as error:
+                    counters['errors'] += 1
+                    await self._respond(writer, {'id': request_id,
+                                                 'error': str(error)})
+                    continue
+                if request.get('cmd') is not None:
+                    await self._respond(writer, {'id': request_id,
+                                                 'stats': self.stats()})
+                    continue
+                # backpressure: stop reading while too many requests
+                # of connection or of server are in flight
+                await pending.acquire()
+                await self._inflight.acquire()
+                counters['in_flight'] += 1
+                counters['max_in_flight'] = max(counters['max_in_flight'],
+                                                counters['in_flight'])
+                task = asyncio.ensure_future(
+                    self._process(writer, request_id, request, pending))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except ConnectionError:
+            pass
+        finally:
+            # requests in flight are cancelled with connection
+            for task in tasks:
+                task.cancel()
+            counters['active_connections'] -= 1
+            writer.close()
+
+
+def serve(host='127.0.0.1', port=8765, path=None, workers=None, **options):
+    """
+    Run server until KeyboardInterrupt.
+    :param host: loopback address for TCP server
+    :param port: TCP port
+    :param path: path of Unix socket, TCP is used if None
+    :param workers: number of worker processes, os.cpu_count() if None
+    :param options: limits of Server
+    """
+    executor = concurrent.futures.ProcessPoolExecutor(workers)
+    server = Server(host, port, path, executor, **options)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(server.start())
+        address = server.address
+        if not isinstance(address, str):
+            address = '{}:{}'.format(*address)
+        print("Serving on", address, flush=True)
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+        executor.shutdown()
+        loop.close()
+
@@ -0,0 +1,209 @@
+"""
+This module provide persistent store of parsed expressions, so service
+that loads many expressions at start skips their parsing.
+
+save_store() writes postfix queues of expressions to binary file.
+ExpressionStore maps file with mmap and decodes entry only when its
+expression is requested, so start of process pays only for used
+expressions. Queues keep names of functions and constants, they are
+resolved against modules of calculator when entry is loaded, see
+Calculator(store=...).
+
+File layout, all integers are little-endian:
+    header: magic, format version, pycalc version, number of entries
+    index: (hash of expression, offset, length) sorted by hash
+    entries: expression, number of tokens, type codes of tokens,
+             indexes of tokens, values of tokens joined with NUL
+"""
+import array
+import hashlib
+import mmap
+import struct
+import sys
+
+from collections import deque
+
+import pycalc
+from pycalc.rpn_calc import _scan, _Token, _TOKENS
+
+_MAGIC = b'PYCALCST'
+_FORMAT = 2
+_HEADER = struct.Struct('<8sH')
+_COUNT = struct.Struct('<I')
+_INDEX = struct.Struct('<QQI')
+_STRING = struct.Struct('<I')
+# Index of token without position in expression, like ARGS
+_NO_INDEX = 0xFFFFFFFF
+
+# Codes of token types
+_TYPES = list(_TOKENS)
+_CODES = {_type: code for code, _type in enumerate(_TYPES)}
+
+
+def expr_hash(expr):
+    """
+    Hash of expression, that is stable between processes.
+    """
+    digest = hashlib.blake2b(expr.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _encode_string(string):
+    data = string.encode('utf-8')
+    return _STRING.pack(len(data)) + data
+
+
+def _encode_entry(expr, queue):
+    """
+    Encode expression and its postfix queue as columns: type codes,
+    indexes and values joined with NUL, which can't be in tokens.
+    """
+    codes = bytes(_CODES[token.type] for token in queue)
+    indexes = array.array('I', (_NO_INDEX if token.index == '' else
+                                token.index for token in queue))
+    if sys.byteorder != 'little':
+        indexes.byteswap()
+    values = '\0'.join(str(token.value) if token.type == 'ARGS'
+                        else token.value for token in queue)
+    return b''.join((_encode_string(expr), _COUNT.pack(len(queue)), codes,
+                     indexes.tobytes(), _encode_string(values)))
+
+
+def save_store(path, exprs):
+    """
+    Parse expressions and write their postfix queues to file.
+    Expressions that fail to parse are skipped, they are parsed again
+    and raise their errors when they are calculated.
+    :param path: path of store file
+    :param exprs: iterable of expressions
+    :return: number of saved expressions
+    """
+    entries = {}
+    for expr in exprs:
+        if expr in entries:
+            continue
+        try:
+            queue = _scan(expr)
+        except (ArithmeticError, IndexError):
+            continue
+        entries[expr] = _encode_entry(expr, queue)
+    version = _encode_string(pycalc.__version__)
+    items = sorted((expr_hash(expr), data) for expr, data in entries.items())
+    offset = (_HEADER.size + len(version) + _COUNT.size +
+              _INDEX.size * len(items))
+    index = []
+    for key, data in items:
+        index.append(_INDEX.pack(key, offset, len(data)))
+        offset += len(data)
+    with open(path, 'wb') as file:
+        file.write(_HEADER.pack(_MAGIC, _FORMAT))
+        file.write(version)
+        file.write(_COUNT.pack(len(items)))
+        file.writelines(index)
+        file.writelines(data for _, data in items)
+    return len(items)
+
+
+class ExpressionStore:
+    """
+    Memory-mapped store file written by save_store().
+
+    Store written by other version of pycalc is stale: it has no entries,
+    so all expressions are parsed again.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of store file
+        :raise ValueError: if file is not a store
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, _format = _HEADER.unpack_from(self._map, 0)
+            if magic != _MAGIC or _format != _FORMAT:
+                raise ValueError("Not a pycalc store:" + str(path))
+            self.version, pos = self._string(_HEADER.size)
+            self._count, = _COUNT.unpack_from(self._map, pos)
+        except (struct.error, UnicodeDecodeError):
+            self._map.close()
+            raise ValueError("Not a pycalc store:" + str(path))
+        self._index = pos + _COUNT.size
+        self.stale = self.version != pycalc.__version__
+
+    def __len__(self):
+        return 0 if self.stale else self._count
+
+    def __contains__(self, expr):
+        return self.get(expr) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap file."""
+        self._map.close()
+
+    def _string(self, pos):
+        """
+        :return: tuple(decoded string at pos, position after it)
+        """
+        length, = _STRING.unpack_from(self._map, pos)
+        pos += _STRING.size
+        return str(self._map[pos:pos + length], 'utf-8'), pos + length
+
+    def _key(self, number):
+        return _INDEX.unpack_from(self._map,
+                                  self._index + number * _INDEX.size)
+
+    def _find(self, expr):
+        """
+        Binary search of entry in index.
+        :return: offset of entry or None
+        """
+        key = expr_hash(expr)
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        # entries with the same hash are checked by expression
+        while low < len(self):
+            entry_key, offset, _ = self._key(low)
+            if entry_key != key:
+                break
+            if self._string(offset)[0] == expr:
+                return offset
+            low += 1
+        return None
+
+    def get(self, expr):
+        """
+        Decode postfix queue of expression.
+        :return: queue of tokens with unresolved names or None
+                 if expression is not in store
+        """
+        offset = self._find(expr)
+        if offset is None:
+            return None
+        _, pos = self._string(offset)
+        count, = _COUNT.unpack_from(self._map, pos)
+        pos += _COUNT.size
+        types = [_TYPES[code] for code in self._map[pos:pos + count]]
+        pos += count
+        indexes = array.array('I', self._map[pos:pos + 4 * count])
+        if sys.byteorder != 'little':
+            indexes.byteswap()
+        values, _ = self._string(pos + 4 * count)
+        queue = list(map(_Token._make,
+                         zip(indexes, types, values.split('\0'))))
+        for number, token in enumerate(queue):
+            if token.type == 'ARGS':
+                queue[number] = _Token('', 'ARGS', int(token.value))
+        return deque(queue)
@@ -0,0 +1,233 @@
+"""
+This module provide evaluate_vectorized() function for evaluation of
+one expression over numpy arrays of variables.
+
+Postfix queue of compiled expression is walked once and every operator
+or function is applied to whole arrays using numpy ufuncs. numpy is
+an optional dependency, the rest of package works without it.
+"""
+import builtins
+import functools
+import math
+import operator
+import warnings
+
+from pycalc.rpn_calc import compile, CompiledExpression
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class VectorizeWarning(RuntimeWarning):
+    """
+    Function has no ufunc equivalent and is applied element by element
+    with numpy.vectorize. Turn it into error with warnings filter.
+    """
+
+
+# Functions, that take iterable, so they can't take elements of arrays
+_ITERABLE_FUNCTIONS = frozenset(
+    getattr(module, name) for module, name in (
+        (builtins, 'sum'), (builtins, 'len'), (builtins, 'sorted'),
+        (builtins, 'any'), (builtins, 'all'), (math, 'fsum'),
+        (math, 'prod')) if hasattr(module, name))
+
+# Names of math functions and names of their numpy ufuncs
+_MATH_UFUNCS = {
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'asin': 'arcsin',
+    'acos': 'arccos', 'atan': 'arctan', 'atan2': 'arctan2', 'sinh': 'sinh',
+    'cosh': 'cosh', 'tanh': 'tanh', 'asinh': 'arcsinh', 'acosh': 'arccosh',
+    'atanh': 'arctanh', 'exp': 'exp', 'expm1': 'expm1', 'log10': 'log10',
+    'log2': 'log2', 'log1p': 'log1p', 'sqrt': 'sqrt', 'fabs': 'fabs',
+    'floor': 'floor', 'ceil': 'ceil', 'trunc': 'trunc', 'hypot': 'hypot',
+    'degrees': 'degrees', 'radians': 'radians', 'copysign': 'copysign',
+    'fmod': 'fmod', 'isnan': 'isnan', 'isinf': 'isinf',
+    'isfinite': 'isfinite', 'pow': 'float_power', 'ldexp': 'ldexp',
+    'gcd': 'gcd',
+}
+
+
+def _log(x, base=None):
+    """
+    math.log(x[, base]) for arrays.
+    """
+    return np.log(x) if base is None else np.log(x) / np.log(base)
+
+
+def _power(base, exponent):
+    """
+    x ** y for arrays with results of python numbers: negative integer
+    exponent gives floats, integer powers, that don't fit int64, are
+    python ints in array of objects instead of wrapping around.
+    """
+    base, exponent = np.asarray(base), np.asarray(exponent)
+    if (base.dtype.kind not in 'iu' or exponent.dtype.kind not in 'iu' or
+            not base.size or not exponent.size):
+        return np.power(base, exponent)
+    if exponent.min() < 0:
+        return np.float_power(base, exponent)
+    bits = int(np.abs(base).max()).bit_length() * int(exponent.max())
+    if bits > 62:
+        return np.power(base.astype(object), exponent)
+    return np.power(base, exponent)
+
+
+def _pow(*args):
+    """
+    pow(x, y[, z]) for arrays, pow with modulo is applied element
+    by element.
+    """
+    if len(args) == 2:
+        return _power(*args)
+    return _vectorize(builtins.pow, args, stacklevel=5)
+
+
+def _cast(dtype):
+    """
+    Return function converting array to dtype, like float(x) for numbers.
+    """
+    return lambda x: np.asarray(x).astype(dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _ufunc_table():
+    """
+    Build table of python operators and functions to numpy equivalents.
+    :return: dict function -> numpy function
+    """
+    table = {
+        operator.add: np.add, operator.sub: np.subtract,
+        operator.mul: np.multiply, operator.truediv: np.true_divide,
+        operator.floordiv: np.floor_divide, operator.mod: np.mod,
+        operator.pow: _power, operator.eq: np.equal,
+        operator.ne: np.not_equal, operator.lt: np.less,
+        operator.le: np.less_equal, operator.gt: np.greater,
+        operator.ge: np.greater_equal,
+        builtins.abs: np.absolute, builtins.pow: _pow,
+        builtins.round: np.round, math.log: _log,
+        builtins.min: lambda *args: functools.reduce(np.minimum, args),
+        builtins.max: lambda *args: functools.reduce(np.maximum, args),
+        builtins.float: _cast(float), builtins.int: _cast(int),
+        builtins.complex: _cast(complex), builtins.bool: _cast(bool),
+    }
+    for name, ufunc in _MATH_UFUNCS.items():
+        if hasattr(math, name):
+            table[getattr(math, name)] = getattr(np, ufunc)
+    return table
+
+
+def _name(function):
+    """
+    Name of function for messages.
+    """
+    return getattr(function, '__name__', repr(function))
+
+
+def _vectorize(function, args, stacklevel=4):
+    """
+    Call function directly for scalar arguments and through
+    numpy.vectorize for arrays, with VectorizeWarning. Elements are
+    python numbers, like in calculation without arrays.
+    """
+    if not any(isinstance(arg, np.ndarray) for arg in args):
+        return function(*args)
+    if function in _ITERABLE_FUNCTIONS:
+        raise TypeError(_name(function) + " takes iterable, it can't be "
+                        "applied to arrays element by element")
+    warnings.warn('No ufunc for function ' + _name(function) +
+                  ', numpy.vectorize is used', VectorizeWarning,
+                  stacklevel=stacklevel)
+    return np.vectorize(function)(*(np.asarray(arg).astype(object)
+                                    for arg in args))
+
+
+def _apply(function, args):
+    """
+    Apply function to arrays with ufunc equivalent if it exists.
+    Functions without equivalent are applied element by element,
+    see _vectorize().
+    """
+    ufunc = _ufunc_table().get(function)
+    if ufunc is None:
+        return _vectorize(function, args)
+    if isinstance(ufunc, np.ufunc) and len(args) != ufunc.nin:
+        # extra arguments of ufunc are its output arrays
+        raise TypeError(_name(function) + " expected " + str(ufunc.nin) +
+                        " arguments, got " + str(len(args)))
+    return ufunc(*args)
+
+
+# Marker of function argument separator on calculation stack
+_COMMA = object()
+
+
+def evaluate_vectorized(expr, **arrays):
+    """
+    Calculate expression over arrays of variables.
+
+    Arrays are broadcast like in numpy, so scalars can be mixed with
+    arrays. Results follow numpy semantics: comparisons produce boolean
+    arrays, division by zero gives inf or nan instead of error. Integer
+    powers are like in python: x**-1 is float and big powers don't wrap
+    around.
+    if(), 'and' and 'or' choose values element by element with
+    numpy.where, so both values are calculated for whole arrays.
+
+    :param expr: EXPRESSION or CompiledExpression, use compile() for
+                 expressions with additional modules
+    :param arrays: values of variables, arrays or scalars
+    :return: numpy array or scalar result
+    """
+    if np is None:
+        raise ImportError("Module not found:numpy")
+    if not isinstance(expr, CompiledExpression):
+        expr = compile(expr)
+    unary = {'UMINUS': np.negative, 'UPLUS': np.positive}
+    binary = _ufunc_table()
+    rpn_stack = []
+    try:
+        for element in expr._queue:
+            if element.type in ('FLOAT', 'INTEGER', 'COMPLEX', 'VALUE',
+                                'ARGS'):
+                rpn_stack.append(element.operator(element.value))
+            elif element.type == 'COMMA':
+                rpn_stack.append(_COMMA)
+            elif element.type == 'VAR':
+                try:
+                    rpn_stack.append(np.asarray(arrays[element.value]))
+                except KeyError:
+                    raise ArithmeticError("Unbound variable:" +
+                                          element.value)
+            elif element.type in ('CALL', 'IF'):
+                fargs = []
+                for number in range(rpn_stack.pop()):
+                    if number and rpn_stack.pop() is not _COMMA:
+                        raise ArithmeticError("Calculation error")
+                    fargs.append(rpn_stack.pop())
+                fargs.reverse()
+                if element.type == 'IF':
+                    rpn_stack.append(np.where(*fargs))
+                else:
+                    rpn_stack.append(_apply(element.value, fargs))
+            elif element.type in ('AND', 'OR'):
+                operand_2, operand_1 = rpn_stack.pop(), rpn_stack.pop()
+                if element.type == 'AND':
+                    rpn_stack.append(np.where(operand_1, operand_2,
+                                              operand_1))
+                else:
+                    rpn_stack.append(np.where(operand_1, operand_1,
+                                              operand_2))
+            elif element.type in unary:
+                rpn_stack.append(unary[element.type](rpn_stack.pop()))
+            else:
+                operand_2, operand_1 = rpn_stack.pop(), rpn_stack.pop()
+                rpn_stack.append(binary[element.operator](operand_1,
+                                                          operand_2))
+        result = rpn_stack.pop()
+    except IndexError:
+        raise ArithmeticError("Calculation error")
+    if rpn_stack:
+        raise ArithmeticError("Calculation error")
+    return result
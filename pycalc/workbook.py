@@ -0,0 +1,233 @@
+"""
+This module provide Workbook of named formulas with incremental
+recalculation, like spreadsheet.
+
+Formula is compiled expression, constants of formula that are not
+found in modules are names of other cells, they are edges of dependency
+graph. Setting a cell marks dirty only formulas that depend on it,
+dirty formulas are recalculated lazily in topological order when their
+values are requested.
+"""
+from collections import deque
+
+from pycalc.rpn_calc import Calculator
+
+
+class CycleError(ArithmeticError):
+    """
+    Formula depends on itself through other formulas.
+    """
+
+
+class Workbook:
+    """
+    Named input values and formulas.
+
+        book = Workbook()
+        book['revenue'] = 100
+        book['cost'] = 60
+        book.set_formula('margin', 'revenue - cost')
+        book.set_formula('ratio', 'margin / revenue')
+        book['ratio']  # 0.4
+        book['cost'] = 70  # only margin and ratio are dirty now
+    """
+
+    def __init__(self, modules=(), calculator=None):
+        """
+        :param modules: Additional modules of formulas
+        :param calculator: Calculator for formulas, new one if None
+        """
+        self.calculator = (Calculator(modules) if calculator is None
+                           else calculator)
+        self.recomputed = 0
+        self._values = {}
+        self._errors = {}
+        self._formulas = {}
+        # names used by formula and formulas using name
+        self._depends = {}
+        self._dependents = {}
+        self._dirty = set()
+
+    def __repr__(self):
+        return '<Workbook of {} cells, {} dirty>'.format(
+            len(self._values.keys() | self._formulas.keys()),
+            len(self._dirty))
+
+    def __contains__(self, name):
+        return name in self._values or name in self._formulas
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        self.set_value(name, value)
+
+    @property
+    def dirty(self):
+        """Names of formulas waiting for recalculation."""
+        return frozenset(self._dirty)
+
+    def depends(self, name):
+        """
+        :return: names used by formula
+        """
+        return frozenset(self._depends.get(name, ()))
+
+    def _check_name(self, name):
+        """
+        Raise ValueError if name can't be used in formulas.
+        """
+        if not isinstance(name, str) or not name.isidentifier():
+            raise ValueError("Invalid name of cell:" + repr(name))
+        try:
+            self.calculator.namespace.find(name)
+        except ArithmeticError:
+            return
+        raise ValueError("Name of cell is name of function or "
+                         "constant:" + name)
+
+    def _mark_dirty(self, name):
+        """
+        Mark all formulas downstream of name as dirty.
+        """
+        queue = deque([name])
+        while queue:
+            for dependent in self._dependents.get(queue.popleft(), ()):
+                if dependent not in self._dirty:
+                    self._dirty.add(dependent)
+                    queue.append(dependent)
+
+    def _unlink(self, name):
+        """
+        Remove edges of formula from dependency graph.
+        """
+        for used in self._depends.pop(name, ()):
+            self._dependents[used].discard(name)
+
+    def set_value(self, name, value):
+        """
+        Set input cell, formula with the same name is removed.
+        """
+        self._check_name(name)
+        if name in self._formulas:
+            self._unlink(name)
+            del self._formulas[name]
+        self._dirty.discard(name)
+        self._errors.pop(name, None)
+        self._values[name] = value
+        self._mark_dirty(name)
+
+    def set_formula(self, name, expr):
+        """
+        Set formula cell, it is calculated when its value is requested.
+        :param name: name of cell
+        :param expr: EXPRESSION with names of other cells
+        :raise CycleError: if formula depends on itself, workbook
+                           is left unchanged
+        """
+        self._check_name(name)
+        compiled = self.calculator.compile(expr)
+        depends = set(compiled.variables)
+        path = self._find_path(depends, name)
+        if path is not None:
+            raise CycleError("Circular reference:" +
+                             ' -> '.join([name] + path))
+        self._unlink(name)
+        self._formulas[name] = compiled
+        self._depends[name] = depends
+        for used in depends:
+            self._dependents.setdefault(used, set()).add(name)
+        self._values.pop(name, None)
+        self._errors.pop(name, None)
+        self._dirty.add(name)
+        self._mark_dirty(name)
+
+    def _find_path(self, starts, target):
+        """
+        Find path from one of start names to target through
+        dependencies of formulas.
+        :return: list of names from start to target or None
+        """
+        parents = dict.fromkeys(starts)
+        queue = deque(starts)
+        while queue:
+            name = queue.popleft()
+            if name == target:
+                path = []
+                while name is not None:
+                    path.append(name)
+                    name = parents[name]
+                return path[::-1]
+            for used in self._depends.get(name, ()):
+                if used not in parents:
+                    parents[used] = name
+                    queue.append(used)
+        return None
+
+    def _dirty_order(self, name):
+        """
+        Dirty formulas, that name depends on, in topological order.
+        """
+        order, visited = [], {name}
+        stack = [(name, iter(self._depends.get(name, ())))]
+        while stack:
+            current, used = stack[-1]
+            for dependency in used:
+                if dependency in self._dirty and dependency not in visited:
+                    visited.add(dependency)
+                    stack.append((dependency, iter(
+                        self._depends.get(dependency, ()))))
+                    break
+            else:
+                stack.pop()
+                order.append(current)
+        return order
+
+    def _recompute(self, name):
+        """
+        Calculate formula from values of its dependencies.
+        """
+        self.recomputed += 1
+        self._dirty.discard(name)
+        self._values.pop(name, None)
+        self._errors.pop(name, None)
+        bindings = {}
+        for used in self._depends[name]:
+            if used in self._errors:
+                self._errors[name] = self._errors[used]
+                return
+            if used in self._values:
+                bindings[used] = self._values[used]
+        calculator = self.calculator
+        try:
+            self._values[name] = self._formulas[name].run(
+                bindings, calculator.budget, calculator.memo)
+        except Exception as error:
+            self._errors[name] = error
+
+    def get(self, name):
+        """
+        Value of cell, dirty formulas it depends on are recalculated.
+        :raise ArithmeticError: error of formula or of its dependencies
+        """
+        if name in self._dirty:
+            for dirty in self._dirty_order(name):
+                self._recompute(dirty)
+        if name in self._errors:
+            raise self._errors[name]
+        try:
+            return self._values[name]
+        except KeyError:
+            raise ArithmeticError("Unbound variable:" + name)
+
+    def recalculate(self):
+        """
+        Recalculate all dirty formulas.
+        :return: number of recalculated formulas
+        """
+        recomputed = self.recomputed
+        for name in list(self._dirty):
+            if name in self._dirty:
+                for dirty in self._dirty_order(name):
+                    self._recompute(dirty)
+        return self.recomputed - recomputed
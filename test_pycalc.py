@@ -2,14 +2,30 @@
 """
 Unit and integration tests for package pycalc
 """
+import math
 import unittest
 import re
 
 from collections import deque
 
-from pycalc.ext_modules import find_attr, import_modules
-from pycalc.rpn_calc import (calc, _Token, _modify_expr, _postfix_queue,
-                             _rpn_calc, _tokenize_expr, _unary_replace)
+from pycalc.ext_modules import find_attr, get_namespace, import_modules
+from pycalc import vectorized
+from pycalc.batch import calc_many, iter_lines, run_batch, _schedule
+from pycalc.cost import estimate_cost
+from pycalc import bench, instrument, server
+from pycalc.budget import Budget, BudgetExceeded
+from pycalc.store import ExpressionStore, save_store
+from pycalc.workbook import CycleError, Workbook
+from pycalc.bench import synthetic_expr, TEST_EXPRESSIONS
+from pycalc.program import (run, PUSH, LOAD, UNARY, BINARY, CALL,
+                            RECALL)
+from pycalc.rpn_calc import (calc, calc_stream, compile, BACKENDS,
+                             Calculator, cache_clear, cache_configure,
+                             cache_info, _LRUCache, _Token, _TOKENS,
+                             fingerprint, _iter_postfix, _iter_tokens,
+                             _iter_unary, _modify_expr, _parse,
+                             _postfix_queue, _rpn_calc, _scan,
+                             _tokenize_expr, _unary_replace)
 
 
 class PycalcUnitTestCase(unittest.TestCase):
@@ -34,11 +50,38 @@ class PycalcUnitTestCase(unittest.TestCase):
         with self.assertRaises(ArithmeticError):
             find_attr("unknown")
 
+    def test_namespace(self):
+        import math
+        namespace = get_namespace(["for_test", "math", "builtins"])
+        self.assertIs(namespace, get_namespace(("for_test", "math",
+                                                "builtins")))
+        self.assertIs(namespace.find("sin"), math.sin)
+        self.assertIs(namespace.find("math.pi"), math.pi)
+        self.assertEqual(namespace.find("π"), 3.14)
+        self.assertIs(namespace.find("pow"), math.pow)
+        self.assertIsNot(get_namespace(["builtins", "math"]).find("pow"),
+                         math.pow)
+        with self.assertRaises(ArithmeticError):
+            namespace.find("for_test.unknown")
+        with self.assertRaises(ImportError):
+            get_namespace(["unknown_module"])
+
+    def test_namespace_lazy_import(self):
+        import sys
+        sys.modules.pop("colorsys", None)
+        calculator = Calculator(["colorsys"])
+        self.assertEqual(calculator.calc("1+1"), 2)
+        self.assertNotIn("colorsys", sys.modules)
+        self.assertEqual(calculator.calc("ONE_THIRD*3"), 1.0)
+        self.assertIn("colorsys", sys.modules)
+
     def test_modify_expr(self):
         self.assertEqual(_modify_expr('2(1+1)'), '2*(1+1)')
         self.assertEqual(_modify_expr('2~1'), '21')
         self.assertEqual(_modify_expr('1*34(1+1)'), '1*34*(1+1)')
         self.assertEqual(_modify_expr('sin(1, )'), 'sin(1)')
+        self.assertEqual(_modify_expr('2(2(1))(3)'), '2*(2*(1))*(3)')
+        self.assertEqual(_modify_expr('2pi+1.5e+a2(1)'), '2*pi+1.5e+a2(1)')
 
     def test_tokenize_expr(self):
         result = []
@@ -48,6 +91,90 @@ class PycalcUnitTestCase(unittest.TestCase):
                   'FUNC', 'CONST', 'DIVIDE', 'INTEGER', 'RPARENT']
         self.assertEqual(result, expect)
 
+    def test_tokenize_same_stream(self):
+        def tokenize_by_types(expr):
+            # Previous implementation: try every regexp of _TOKENS in order
+            token_expr = []
+            while expr:
+                for (_type, (pattern, _, _)) in _TOKENS.items():
+                    t_match = (re.match(pattern, expr)
+                               if pattern is not None else None)
+                    if t_match:
+                        if _type != 'SPACE':
+                            token_expr.append(_Token(len(token_expr), _type,
+                                                     t_match.group()))
+                        expr = expr[t_match.end():]
+                        break
+                else:
+                    raise ArithmeticError("EXPRESSION Tokenize Error")
+            return token_expr
+
+        for expr in ("2j+3J*1jj", "5 > 6 >= 6 <= 7 != 7 == 8 < 9",
+                     "ab(1,2)//3**4^5", "  .5 - 1.0e", synthetic_expr(3000)):
+            expr = _modify_expr(expr)
+            self.assertEqual(_tokenize_expr(expr), tokenize_by_types(expr))
+        with self.assertRaises(ArithmeticError):
+            _tokenize_expr("1 ! 2")
+
+    def test_scan_same_queue(self):
+        import contextlib
+        import io
+
+        def staged(expr):
+            try:
+                return _parse(expr, lambda *args, **kwargs: None)
+            except ArithmeticError:
+                return ArithmeticError
+
+        def fused(expr):
+            try:
+                return _scan(expr)
+            except ArithmeticError:
+                return ArithmeticError
+
+        for expr in list(TEST_EXPRESSIONS) + [
+                "", "1 2", "123e", "==7", "sin(1,)", "max(1, 2 , )", "2 (3)",
+                ".5(2)", "-+-2^-3", "log10(100)", "2\t(3)", "1 $+ 2",
+                "2pi", "(1)(2)", "2(2(1))", "2.5sin(1)if(1,2,3)"]:
+            self.assertEqual(fused(expr), staged(expr))
+        self.assertEqual(calc("2pi*(1)(2)"), calc("2*pi*(1)*(2)"))
+        # junk characters and verbose mode are parsed by _parse()
+        self.assertEqual(calc("2\tpi"), calc("2*pi"))
+        calculator = Calculator()
+        self.assertEqual(calculator.calc("2pi"), calc("2*pi"))
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(calculator.calc("2pi", verbose=True),
+                             calc("2*pi"))
+        self.assertIn("EXPR:\t 2*pi", out.getvalue())
+        with self.assertRaises(ArithmeticError):
+            calc("2e")
+        with self.assertRaises(ArithmeticError):
+            calc("sin(")
+
+    def test_stream(self):
+        expr = "12.5**2 + sin(0) // 3 >= abs(2j) and pow(2, pow(3, 2))"
+        for size in (1, 2, 3, 5):
+            chunks = [expr[i:i + size] for i in range(0, len(expr), size)]
+            self.assertEqual(list(_iter_tokens(iter(chunks))),
+                             _tokenize_expr(expr))
+            self.assertEqual(calc_stream(chunks), calc(expr))
+        # postfix tokens are produced before expression is read
+        chunks = iter(['1 + '] * 1000 + ['1'])
+        postfix = _iter_postfix(_iter_unary(_iter_tokens(chunks)))
+        self.assertEqual([next(postfix).value for _ in range(3)],
+                         ['1', '1', '+'])
+        self.assertGreater(len(list(chunks)), 990)
+        for expr in ("", "sin(", "1 $ 2", "2(3)", "1.5,!= ", ",-",
+                     "max(,2)", "if(2", "5 log(1 ", "(1,2)", "1+", "()",
+                     "if()", "2log(-)"):
+            with self.assertRaises(ArithmeticError):
+                calc_stream(expr)
+        self.assertEqual(calc_stream("max(1, (-2)) + 1"), 2)
+        self.assertLess(calc_stream("random()", ["random"]), 1)
+        self.assertEqual(list(_scan("( ,\t)")), [])
+        with self.assertRaises(ArithmeticError):
+            _scan("(1, 2)")
+
     def test_unary_replace(self):
         # tokenized_expr = _tokenize_expr("-1-2*(+3)**-4")
         tokenized_expr = [_Token(index=0, type='MINUS', value='-'),
@@ -234,5 +361,678 @@ class PycalcUnitTestCase(unittest.TestCase):
                 calc(expr)
 
 
+class CompiledExpressionTestCase(unittest.TestCase):
+    def test_evaluate(self):
+        compiled = compile("x*sin(pi/2) + y**2 - e")
+        self.assertEqual(compiled.variables, ('x', 'y'))
+        from math import e
+        for x, y in ((1, 2), (0.5, -3), (10, 0)):
+            self.assertEqual(compiled.evaluate(x=x, y=y, z=1),
+                             x + y ** 2 - e)
+
+    def test_evaluate_modules(self):
+        compiled = compile("multpi(k) + π", ["for_test"])
+        self.assertEqual(compiled.variables, ('k',))
+        self.assertEqual(compiled.evaluate(k=2), 6.28 + 3.14)
+
+    def test_evaluate_errors(self):
+        with self.assertRaises(ArithmeticError):
+            compile("1 + 2(3 * 4))")
+        with self.assertRaises(ArithmeticError):
+            compile("x + 1").evaluate(y=1)
+        with self.assertRaises(ArithmeticError):
+            compile("x / y").evaluate(x=1, y=0)
+
+    def test_optimize(self):
+        from math import pi, sqrt
+        compiled = compile("2*pi/360*x + sqrt(2)**2", optimize=True)
+        self.assertEqual(compiled.removed_nodes, 8)
+        self.assertEqual(compiled.evaluate(x=3), 2 * pi / 360 * 3 +
+                         sqrt(2) ** 2)
+        compiled = compile("sin(x)*1 + (cos(x)**1-0) + (0+y) + x*1",
+                           optimize=True)
+        self.assertEqual(compiled.removed_nodes, 6)
+        self.assertEqual(compiled.evaluate(x=0, y=True), 2.0)
+        self.assertEqual(compile("1/0 + x", optimize=True).removed_nodes, 0)
+        for expr in ("1/0 + x", "x + 1 2"):
+            with self.assertRaises(ArithmeticError):
+                compile(expr, optimize=True).evaluate(x=1)
+        # tuples of modf() and frexp() are not simplified as numbers
+        for expr in ("modf(x)-0", "frexp(x)+0"):
+            with self.assertRaises(TypeError):
+                compile(expr, optimize=True).evaluate(x=1.5)
+
+    def test_specialize(self):
+        expr = ("x * (rate * 12 + sqrt(base)) + "
+                "if(limit > 100, x ** 2, -x) + (flag and sin(x))")
+        tenant = {'rate': 0.5, 'base': 16, 'limit': 150, 'flag': 0}
+        calculator = Calculator()
+        compiled = calculator.compile(expr)
+        specialized = calculator.specialize(expr, other=1, **tenant)
+        self.assertEqual(specialized.variables, ('x',))
+        self.assertEqual(specialized.removed_nodes, 19)
+        self.assertIs(calculator.specialize(expr, **tenant), specialized)
+        for x in (-2, 0, 3.5):
+            self.assertEqual(specialized.evaluate(x=x),
+                             compiled.evaluate(x=x, **tenant))
+        partly = compiled.specialize(limit=1, flag=[0])
+        self.assertEqual(partly.variables, ('x', 'rate', 'base'))
+        self.assertEqual(partly.evaluate(x=2, rate=1, base=4),
+                         compiled.evaluate(x=2, rate=1, base=4, limit=1,
+                                           flag=[0]))
+        self.assertIsNot(calculator.specialize(expr, flag=[0]),
+                         calculator.specialize(expr, flag=[0]))
+        self.assertEqual(compile("if(1, x, y) + (0 or y)",
+                                 optimize=True).removed_nodes, 8)
+
+    def test_program(self):
+        import math
+        program = compile("-max(1, 2.5, x) + pow(2, 3)").program
+        self.assertEqual(program.opcodes, (PUSH, PUSH, LOAD, CALL, UNARY,
+                                           PUSH, PUSH, CALL, BINARY))
+        self.assertEqual(program.argcounts, (0, 0, 0, 3, 1, 0, 0, 2, 2))
+        self.assertIs(program.operands[7], math.pow)
+        self.assertEqual(run(program, {'x': 3}), 5.0)
+        namespace = get_namespace(['math', 'builtins'])
+        for expr in TEST_EXPRESSIONS:
+            token_expr = _tokenize_expr(_modify_expr(expr))
+            _unary_replace(token_expr)
+            self.assertEqual(run(compile(expr).program, None),
+                             _rpn_calc(_postfix_queue(token_expr),
+                                       namespace=namespace))
+        for expr in ("1 2", "sin(,1)", "1,2", "+"):
+            with self.assertRaises(ArithmeticError):
+                compile(expr)
+
+    def test_closure_backend(self):
+        for expr in TEST_EXPRESSIONS:
+            self.assertEqual(compile(expr, backend='closure').evaluate(),
+                             compile(expr).evaluate())
+        compiled = compile("sin(x)*sin(x) + max(x, 1, y) - 2/x",
+                           optimize=True, backend='closure')
+        self.assertIsNotNone(compiled._closure)
+        self.assertEqual(compiled.program.registers, 1)
+        self.assertEqual(compiled.evaluate(x=2, y=3),
+                         compile(compiled.expr).evaluate(x=2, y=3))
+        with self.assertRaises(ArithmeticError):
+            compiled.evaluate(x=0, y=3)
+        with self.assertRaises(ArithmeticError):
+            compiled.evaluate(x=2)
+        deep = compile('abs(' * 300 + '-1' + ')' * 300, backend='closure')
+        self.assertIsNone(deep._closure)
+        self.assertEqual(deep.evaluate(), 1)
+        with self.assertRaises(ValueError):
+            compile("1", backend='jit')
+
+    def test_lazy_branches(self):
+        self.assertEqual(calc("if(1, 2, 1/0)"), 2)
+        self.assertEqual(calc("0 and 1/0"), 0)
+        self.assertEqual(calc("1 or 1/0"), 1)
+        self.assertEqual(calc("if(0, 1, if(2 < 3 and 3 < 4, 2, 3))"), 2)
+        self.assertEqual(calc("pow(2, pow(3, 2))"), 512)
+        with self.assertRaises(ArithmeticError):
+            calc("if(1, 2)")
+        expr = "if(x, sin(x), cos(x)) + (x or sin(x)) + (x and 1/x)"
+        for backend in BACKENDS:
+            for x in (0, 2):
+                with instrument.recording() as recorder:
+                    compiled = compile(expr, backend=backend)
+                    self.assertEqual(compiled.evaluate(x=x),
+                                     compile(expr).evaluate(x=x))
+                self.assertEqual(len(recorder.snapshot()['calls']),
+                                 1 if x else 2)
+        calculator = Calculator(budget=Budget(max_operations=3))
+        self.assertEqual(calculator.calc("if(1, 2, 1+1+1+1+1)"), 2)
+
+
+class CalculatorTestCase(unittest.TestCase):
+    def test_calculator(self):
+        calculator = Calculator(["for_test"], optimize=True)
+        self.assertEqual(calculator.calc("multpi(2)"), 6.28)
+        self.assertEqual(calculator.evaluate("x*π", x=2), 6.28)
+        self.assertEqual(calculator.compile("π*2").removed_nodes, 2)
+        self.assertEqual(calculator.cache_info().currsize, 3)
+        calculator.cache_clear()
+        self.assertEqual(calculator.cache_info().currsize, 0)
+        with self.assertRaises(ImportError):
+            Calculator(["unknown_module"])
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        calculators = (Calculator(["cmath"]), Calculator())
+
+        def work(i):
+            if i % 2:
+                return calculators[0].calc("sqrt(-4)") == 2j
+            try:
+                calculators[1].calc("sqrt(-4)")
+            except ValueError:
+                return calc("sqrt(4)") == 2.0
+            return False
+
+        with ThreadPoolExecutor(8) as pool:
+            self.assertTrue(all(pool.map(work, range(400))))
+
+
+class BudgetTestCase(unittest.TestCase):
+    def test_limits(self):
+        calculator = Calculator(budget=Budget(max_bits=64, max_operations=5,
+                                              timeout=1, max_tokens=20))
+        self.assertEqual(calculator.calc("2**63"), 2 ** 63)
+        self.assertEqual(calculator.evaluate("x*y", x=2 ** 32, y=2), 2 ** 33)
+        for expr in ("2**64", "9**9**9", "factorial(10**6)", "x*x",
+                     "1+1+1+1+1+1+1", "1+" * 10 + "1"):
+            with self.assertRaises(BudgetExceeded):
+                calculator.evaluate(expr, x=2 ** 40)
+        with self.assertRaises(ArithmeticError):
+            calculator.calc("2**64")
+
+    @unittest.skipIf(not hasattr(math, 'comb'), "math.comb is not present")
+    def test_comb_perm(self):
+        import time
+        calculator = Calculator(budget=Budget(max_bits=1000))
+        self.assertEqual(calculator.calc("comb(10**6, 3)"),
+                         math.comb(10 ** 6, 3))
+        self.assertEqual(calculator.calc("perm(100, 50)"),
+                         math.perm(100, 50))
+        # rejected before calculation, that takes many seconds
+        started = time.monotonic()
+        for expr in ("comb(2*10**6, 10**6)", "perm(10**6, 5*10**5)",
+                     "perm(10**5)"):
+            with self.assertRaises(BudgetExceeded):
+                calculator.calc(expr)
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_timeout(self):
+        calculator = Calculator(["time"], budget=Budget(timeout=0.01))
+        with self.assertRaises(BudgetExceeded):
+            calculator.calc("sleep(0.02) + sleep(0.02)")
+
+    def test_fold(self):
+        expr = compile("2**10+9**9**9+x", optimize=True)
+        self.assertEqual(expr.removed_nodes, 4)
+        with self.assertRaises(BudgetExceeded):
+            expr.run({'x': 1}, Budget(max_bits=1000))
+        calculator = Calculator(budget=Budget(max_bits=100), optimize=True)
+        with self.assertRaises(BudgetExceeded):
+            calculator.calc("2**4000")
+
+
+class MemoTestCase(unittest.TestCase):
+    def test_memo(self):
+        import math
+        calculator = Calculator(memoize=True)
+        self.assertEqual(calculator.evaluate("gamma(x)", x=5), 24.0)
+        self.assertEqual(calculator.evaluate("gamma(x)", x=5), 24.0)
+        self.assertEqual(calculator.memo.info()['math.gamma'].hits, 1)
+        self.assertEqual(calculator.memo.hit_rate(), 0.5)
+        self.assertEqual(calculator.evaluate("max(x)", x=[1, 2]), 2)
+        self.assertEqual(calculator.memo.unhashable, 1)
+        self.assertIs(type(calculator.evaluate("abs(x)", x=1)), int)
+        self.assertIs(type(calculator.evaluate("abs(x)", x=1.0)), float)
+        self.assertEqual(calculator.evaluate("atan2(0.0, x)", x=0.0), 0.0)
+        self.assertEqual(calculator.evaluate("atan2(0.0, x)", x=-0.0),
+                         math.pi)
+        calculator.memo.clear()
+        self.assertEqual(calculator.memo.info(), {})
+
+    def test_common_subexpressions(self):
+        expr = "sin(x)*sin(x) + cos(x)*cos(x) + (x+1)/(x+1)"
+        compiled = compile(expr, optimize=True)
+        self.assertEqual(compiled.program.registers, 3)
+        self.assertEqual(compiled.program.opcodes.count(CALL), 2)
+        self.assertEqual(compiled.program.opcodes.count(RECALL), 3)
+        for x in (0.5, 2, -3):
+            self.assertAlmostEqual(compiled.evaluate(x=x),
+                                   compile(expr).evaluate(x=x))
+        expr = ("sin(x) + if(x, sin(x)*sin(x), cos(x)*cos(x)) + "
+                "(x and cos(x))")
+        compiled = compile(expr, optimize=True)
+        self.assertEqual(compiled.program.registers, 2)
+        for x in (0, 2):
+            for backend in BACKENDS:
+                self.assertEqual(
+                    compile(expr, optimize=True, backend=backend).evaluate(
+                        x=x), compile(expr).evaluate(x=x))
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    def tearDown(self):
+        cache_configure()
+        cache_clear()
+
+    def test_calc_cache(self):
+        cache_clear()
+        cache_configure(maxsize=2)
+        self.assertEqual(calc("1+2"), 3)
+        self.assertEqual(calc("1+2"), 3)
+        self.assertEqual(calc("multpi(1)", ["for_test"]), 3.14)
+        calc("2+2")
+        info = cache_info()
+        self.assertEqual((info.hits, info.misses, info.evictions),
+                         (1, 3, 1))
+        self.assertEqual(info.currsize, 2)
+        with self.assertRaises(ArithmeticError):
+            calc("1 +")
+        cache_clear()
+        self.assertEqual(cache_info().currsize, 0)
+
+    def test_fingerprint(self):
+        forms = ("2(x)^2 + max(1, 2, )", "2*((x))**2+max(1,2)",
+                 "02 * x ** 2 + max( 1 ,2 )")
+        self.assertEqual(len({fingerprint(expr) for expr in forms}), 1)
+        self.assertNotEqual(fingerprint(forms[0]), fingerprint("2.0*x^2"))
+        calculator = Calculator()
+        compiled = calculator.compile(forms[0])
+        for expr in forms:
+            self.assertIs(calculator.compile(expr), compiled)
+        self.assertEqual(calculator.cache_info().currsize, 3)
+        self.assertIsNot(calculator.compile("2 * x ** 2 + max(1, 2)",
+                                            optimize=True), compiled)
+        with instrument.recording() as recorder:
+            results = list(calc_many(
+                ["sin(1)", " sin( 1 )", "sin(1.0)", "multpi(1)",
+                 "multpi( 1 )"], ["for_test"], 1))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(recorder.snapshot()['calls'],
+                         {'math.sin': 2, 'for_test.multpi': 2})
+
+    def test_ttl(self):
+        now = [0.0]
+        cache = _LRUCache(maxsize=None, ttl=10, timer=lambda: now[0])
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 10.0
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.info()[:3], (1, 1, 1))
+
+
+class VectorizedTestCase(unittest.TestCase):
+    @unittest.skipIf(vectorized.np is None, "numpy is not installed")
+    def test_evaluate_vectorized(self):
+        import math
+        import warnings
+        np = vectorized.np
+        x = np.linspace(-3, 3, 101)
+        y = np.arange(101)
+        result = vectorized.evaluate_vectorized(
+            "sin(x)**2 + cos(x)^2 - -y/2 + log(y+1, 2) + pi", x=x, y=y)
+        for i in range(len(x)):
+            self.assertAlmostEqual(
+                result[i], math.sin(x[i]) ** 2 + math.cos(x[i]) ** 2 +
+                y[i] / 2 + math.log(y[i] + 1, 2) + math.pi)
+        self.assertEqual(vectorized.evaluate_vectorized(
+            "x >= 0", x=x).dtype, bool)
+        self.assertEqual(vectorized.evaluate_vectorized("2*x", x=3), 6)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", vectorized.VectorizeWarning)
+            with self.assertRaises(vectorized.VectorizeWarning):
+                vectorized.evaluate_vectorized("factorial(y)", y=y)
+        with self.assertRaises(ArithmeticError):
+            vectorized.evaluate_vectorized("x + z", x=x)
+
+    @unittest.skipIf(vectorized.np is None, "numpy is not installed")
+    def test_like_scalar(self):
+        np = vectorized.np
+        x = np.arange(1, 5)
+        for expr in ("x**-1", "x**40", "x**x", "2**x", "pow(x, 2)"):
+            result = vectorized.evaluate_vectorized(expr, x=x)
+            for i in range(len(x)):
+                self.assertEqual(result[i],
+                                 calc(expr.replace('x', str(x[i]))))
+        with self.assertWarns(vectorized.VectorizeWarning):
+            result = vectorized.evaluate_vectorized(
+                compile("pow(x, 2, 3)", ["builtins"]), x=x)
+        self.assertEqual(list(result), [1, 1, 0, 1])
+        for expr in ("pow(x, 2, 3)", "sum(x)"):
+            with self.assertRaises(TypeError):
+                vectorized.evaluate_vectorized(expr, x=x)
+
+    def test_without_numpy(self):
+        np, vectorized.np = vectorized.np, None
+        try:
+            with self.assertRaises(ImportError):
+                vectorized.evaluate_vectorized("x + 1", x=[1, 2])
+        finally:
+            vectorized.np = np
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            self.path = file.name
+
+    def tearDown(self):
+        import os
+        os.remove(self.path)
+
+    def test_store(self):
+        exprs = ["multpi(2) + π", "max(1, 2, x)", "-sin(-x)", "max()",
+                 "a.b(", "multpi(2) + π"]
+        self.assertEqual(save_store(self.path, exprs), 4)
+        with ExpressionStore(self.path) as store:
+            self.assertEqual(len(store), 4)
+            self.assertNotIn("a.b(", store)
+            self.assertEqual(list(store.get("max(1, 2, x)")),
+                             list(_postfix_queue(_tokenize_expr(
+                                 "max(1, 2, x)"))))
+            # names are resolved against modules of calculator
+            calculator = Calculator(["for_test"], store=store)
+            self.assertEqual(calculator.calc("multpi(2) + π"), 9.42)
+            self.assertEqual(calculator.evaluate("max(1, 2, x)", x=3), 3)
+            with self.assertRaises(ArithmeticError):
+                Calculator(store=store).calc("multpi(2) + π")
+
+    def test_stale(self):
+        import pycalc
+        from unittest import mock
+        with mock.patch.object(pycalc, '__version__', '0.0.0'):
+            save_store(self.path, ["1 + 1"])
+        with ExpressionStore(self.path) as store:
+            self.assertTrue(store.stale)
+            self.assertIsNone(store.get("1 + 1"))
+        with open(self.path, 'wb') as file:
+            file.write(b'not a store')
+        with self.assertRaises(ValueError):
+            ExpressionStore(self.path)
+
+
+class BatchTestCase(unittest.TestCase):
+    def test_iter_lines(self):
+        import io
+        import os
+        import tempfile
+        with tempfile.NamedTemporaryFile('wb', delete=False) as file:
+            file.write('1+1\r\n\nπ*2\n'.encode() + b'1\xff\n2*2')
+        try:
+            lines = list(iter_lines(file.name))
+            self.assertEqual(lines[:3], ['1+1', '', 'π*2'])
+            self.assertIsInstance(lines[3], UnicodeDecodeError)
+            self.assertEqual(lines[4], '2*2')
+            out, err = io.StringIO(), io.StringIO()
+            self.assertEqual(run_batch(lines, ['for_test'], out, err), 1)
+            self.assertEqual(out.getvalue().split(), ['2', '6.28', '4'])
+            self.assertTrue(err.getvalue().startswith("ERROR: line 4:"))
+            open(file.name, 'w').close()
+            self.assertEqual(list(iter_lines(file.name)), [])
+        finally:
+            os.remove(file.name)
+
+    def test_run_batch(self):
+        import io
+        out, err = io.StringIO(), io.StringIO()
+        errors = run_batch(['1+1', '', '1 +', 'π*2', 'sqrt(-1)'],
+                           ['for_test'], out, err)
+        self.assertEqual(errors, 2)
+        self.assertEqual(out.getvalue().split(), ['2', '6.28'])
+        self.assertEqual([line.split(':')[1] for line in
+                          err.getvalue().splitlines()],
+                         [' line 3', ' line 5'])
+
+    def test_calc_many(self):
+        exprs = ['{}*π'.format(i) for i in range(50)]
+        exprs[7] = '1/0'
+        for workers in (1, 2):
+            results = list(calc_many(iter(exprs), ['for_test'], workers, 4))
+            self.assertEqual(len(results), 50)
+            self.assertIsInstance(results[7], ArithmeticError)
+            self.assertEqual(results[49], 49 * 3.14)
+        with self.assertRaises(ImportError):
+            next(calc_many(exprs, ['unknown_module'], 2))
+
+    def test_schedule(self):
+        self.assertLess(estimate_cost("1 + 2").total,
+                        estimate_cost("sin(1) + cos(2) * 3").total)
+        self.assertLess(estimate_cost("2**100").total,
+                        estimate_cost("2**100000").total)
+        heavy = estimate_cost("factorial(10**5)")
+        self.assertEqual((heavy.tokens, heavy.depth), (5, 2))
+        self.assertGreater(heavy.bits, 10 ** 6)
+        self.assertGreater(estimate_cost("9**9**9").total, heavy.total)
+        # exponents of unknown value
+        for expr in ("2**(7//2)", "2**(3%2)", "0**(5%3)"):
+            self.assertGreater(estimate_cost(expr).total, 0)
+        outliers, bins = _schedule([100, 1, 2, 3, 4, 5, 1], 2)
+        self.assertEqual(outliers, [0])
+        self.assertEqual(sorted(sum(bins, [])), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(sorted(len(indexes) for indexes in bins), [3, 3])
+        exprs = ['{}*π'.format(i) for i in range(30)]
+        exprs[5], exprs[20] = 'factorial(3000) % 7', '1 +'
+        # literal over limit of digits of int() fails only its line
+        exprs[25] = '9' * 5000
+        self.assertGreater(estimate_cost(exprs[25]).bits, 16000)
+        results = list(calc_many(exprs, ['for_test'], 2, 4, schedule=True))
+        self.assertEqual(results[5], 0)
+        self.assertIsInstance(results[20], ArithmeticError)
+        self.assertEqual([isinstance(result, Exception) for result in results],
+                         [isinstance(result, Exception) for result in
+                          calc_many(exprs, ['for_test'], 2, 4)])
+        self.assertEqual(results[29], 29 * 3.14)
+        self.assertEqual(len(results), 30)
+
+
+class WorkbookTestCase(unittest.TestCase):
+    def test_recompute(self):
+        book = Workbook()
+        book['revenue'] = 100
+        book['cost'] = 60
+        book.set_formula('margin', 'revenue - cost')
+        book.set_formula('ratio', 'margin / revenue')
+        book.set_formula('other', 'cost * 2')
+        self.assertEqual(book.dirty, {'margin', 'ratio', 'other'})
+        self.assertEqual(book['ratio'], 0.4)
+        self.assertEqual(book.recomputed, 2)
+        self.assertEqual(book.dirty, {'other'})
+        book['revenue'] = 200
+        # other doesn't depend on revenue, it is still dirty from start
+        self.assertEqual(book.dirty, {'margin', 'ratio', 'other'})
+        self.assertEqual(book.recalculate(), 3)
+        self.assertEqual(book['ratio'], 0.7)
+        self.assertEqual(book.recalculate(), 0)
+        book.set_formula('cost', 'revenue / 4')
+        self.assertEqual(book['margin'], 150)
+        self.assertEqual(book.depends('ratio'), {'margin', 'revenue'})
+
+    def test_errors(self):
+        book = Workbook(["for_test"])
+        book.set_formula('a', 'b * π')
+        book.set_formula('c', 'a / d')
+        with self.assertRaises(ArithmeticError):
+            book['c']
+        book['b'] = 1
+        book['d'] = 0
+        self.assertEqual(book['a'], 3.14)
+        with self.assertRaises(ArithmeticError):
+            book['c']
+        book['d'] = 2
+        self.assertEqual(book['c'], 1.57)
+        with self.assertRaises(CycleError):
+            book.set_formula('b', 'c + 1')
+        self.assertEqual(book['b'], 1)
+        with self.assertRaises(ValueError):
+            book['sin'] = 1
+
+
+class BenchTestCase(unittest.TestCase):
+    def test_workloads(self):
+        for exprs in bench.workloads().values():
+            for expr in exprs:
+                calc(expr)
+
+    def test_compare(self):
+        corpus = {'small': ('1+2', 'sin(pi/2)')}
+        results = bench.run_suite(corpus, target=0.0001, repeat=1)
+        self.assertEqual(set(results['results']['small']),
+                         {'scan', 'modify', 'tokenize', 'unary', 'postfix',
+                          'rpn_calc', 'program', 'closure', 'calc',
+                          'calc_cold'})
+        baseline = {'results': {'small': {'calc': 1.0, 'program': 1.0}}}
+        current = {'results': {'small': {'calc': 1.5, 'program': 1.05},
+                               'new': {'calc': 9.0}}}
+        regressions = bench.compare(current, baseline, 0.1)
+        self.assertEqual([r['stage'] for r in regressions], ['calc'])
+        self.assertEqual(bench.compare(current, baseline, 0.1,
+                                       {'calc': 0.6}), [])
+
+    def test_cost_accuracy(self):
+        exprs = ('1', '1+2*3', 'factorial(3000)', '3**50000')
+        correlation, per_unit, results = bench.cost_accuracy(
+            exprs, target=0.0001, repeat=1)
+        self.assertEqual([expr for expr, _, _ in results], list(exprs))
+        self.assertGreater(correlation, 0)
+        self.assertGreater(per_unit, 0)
+
+    def test_startup(self):
+        startup = bench.measure_startup(repeat=1)
+        self.assertEqual(set(startup), {'interpreter', 'import', 'cli'})
+        imported = bench.import_times()
+        self.assertIn('pycalc.rpn_calc', imported)
+        # command line calculator doesn't load these modules
+        for module in ('argparse', 'multiprocessing', 'pycalc.batch',
+                       'pycalc.cost', 'pycalc.workbook'):
+            self.assertNotIn(module, imported)
+        import pycalc
+        self.assertIs(pycalc.Workbook, Workbook)
+        self.assertIs(pycalc.calc_many, calc_many)
+
+
+class InstrumentTestCase(unittest.TestCase):
+    def test_recording(self):
+        cache_clear()
+        with instrument.recording() as recorder:
+            for _ in range(3):
+                calc("max(1, 2) + sin(pi/2) * multpi(2)", ["for_test"])
+            compile("abs(x) + 1").evaluate(x=-1)
+        calc("abs(1)")
+        snapshot = recorder.snapshot()
+        stages = snapshot['stages']
+        self.assertEqual([stages[stage]['count'] for stage in
+                          instrument.STAGES], [2, 0, 0, 0, 0, 4])
+        self.assertEqual(snapshot['tokens']['max'], 15)
+        self.assertEqual(snapshot['stack_depth']['max'], 3)
+        self.assertEqual(snapshot['calls'], {'max': 3, 'math.sin': 3,
+                                             'for_test.multpi': 3,
+                                             'abs': 1})
+        merged = instrument.merge_snapshots(snapshot, snapshot)
+        self.assertEqual(merged['calls']['max'], 6)
+        self.assertEqual(merged['stages']['evaluate']['count'], 8)
+        self.assertEqual(sum(c for _, c in merged['tokens']['buckets']), 4)
+        self.assertEqual(instrument._recorders, [])
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(2)
+        self.server = server.Server(executor=self.executor, max_pending=2)
+        self.loop.run_until_complete(self.server.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.close())
+        self.executor.shutdown()
+        self.loop.close()
+
+    def request(self, *lines):
+        import asyncio
+        import json
+
+        async def client():
+            reader, writer = await asyncio.open_connection(
+                *self.server.address)
+            # pipeline all requests before reading responses
+            writer.write(b''.join(line.encode() + b'\n' for line in lines))
+            writer.write_eof()
+            responses = [json.loads(line.decode())
+                         for line in (await reader.read()).splitlines()]
+            writer.close()
+            return responses
+
+        return self.loop.run_until_complete(asyncio.wait_for(client(), 30))
+
+    def test_requests(self):
+        responses = self.request(
+            '{"id": 1, "expr": "1+1"}',
+            '{"id": 2, "expr": "x*2", "vars": {"x": 3}}',
+            '{"id": 3, "expr": "sqrt(-1)", "modules": ["cmath"]}',
+            '{"id": 4, "expr": "1/0"}',
+            '{"id": 5, "expr": 1}',
+            'junk',
+            '{"id": 6, "cmd": "stats"}')
+        by_id = {response['id']: response for response in responses}
+        self.assertEqual(by_id[1], {'id': 1, 'result': 2})
+        self.assertEqual(by_id[2], {'id': 2, 'result': 6})
+        self.assertEqual(by_id[3], {'id': 3, 'result': '1j'})
+        self.assertEqual(by_id[4], {'id': 4, 'error': 'Division by zero'})
+        self.assertIn('error', by_id[5])
+        self.assertEqual(by_id[None], {'id': None, 'error': 'Invalid JSON'})
+        self.assertEqual(by_id[6]['stats']['requests'], 7)
+
+    def test_vars(self):
+        responses = self.request(
+            '{"id": 1, "expr": "expr+budget", '
+            '"vars": {"expr": 1, "budget": 2.5}}',
+            '{"id": 2, "expr": "len(x*10**7)", "vars": {"x": [1, 2]}}',
+            '{"id": 3, "expr": "x", "vars": {"x": "1"}}')
+        by_id = {response['id']: response for response in responses}
+        self.assertEqual(by_id[1], {'id': 1, 'result': 3.5})
+        self.assertEqual(by_id[2],
+                         {'id': 2, 'error': 'vars must have number values'})
+        self.assertIn('error', by_id[3])
+
+    def test_close_idle(self):
+        import asyncio
+
+        async def connect():
+            return await asyncio.open_connection(*self.server.address)
+
+        _, writer = self.loop.run_until_complete(connect())
+        self.loop.run_until_complete(
+            asyncio.wait_for(self.server.close(timeout=0.1), 5))
+        self.assertEqual(self.server.stats()['active_connections'], 0)
+        writer.close()
+
+    def test_worker_errors(self):
+        from concurrent.futures.process import BrokenProcessPool
+
+        responses = self.request('{"id": 1, "expr": "exit()"}',
+                                 '{"id": 2, "expr": "1+1"}')
+        by_id = {response['id']: response for response in responses}
+        self.assertEqual(by_id[1], {'id': 1, 'error': 'SystemExit'})
+        self.assertEqual(by_id[2], {'id': 2, 'result': 2})
+
+        async def run_in_executor(executor, function, *args):
+            raise BrokenProcessPool("pool is broken")
+
+        self.loop.run_in_executor = run_in_executor
+        self.assertEqual(self.request('{"id": 3, "expr": "1"}'), [
+            {'id': 3, 'error': 'Worker error:pool is broken'}])
+
+    def test_process_pool(self):
+        self.loop.run_until_complete(self.server.close())
+        # workers of own pool are started before first connection,
+        # so they don't keep its socket open after server closes it
+        self.server = server.Server()
+        self.loop.run_until_complete(self.server.start())
+        self.assertEqual(self.request('{"id": 1, "expr": "2"}'),
+                         [{'id': 1, 'result': 2}])
+
+    def test_backpressure(self):
+        lines = ['{{"id": {0}, "expr": "{0}*2"}}'.format(i)
+                 for i in range(50)]
+        responses = self.request(*lines)
+        self.assertEqual(sorted(r['result'] for r in responses),
+                         list(range(0, 100, 2)))
+        stats = self.server.stats()
+        self.assertLessEqual(stats['max_in_flight'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_local_only(self):
+        with self.assertRaises(ValueError):
+            server.Server('0.0.0.0')
+
+
 if __name__ == '__main__':
     unittest.main()